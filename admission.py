@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+"""admission.py -- Part of Alexa App for Appdaemon
+Copyright (C) 2021 foorensic
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+https://github.com/foorensic/appdaemon-alexa
+
+Admission control: rate limits and load shedding for requests
+
+"""
+import threading
+import time
+from collections import OrderedDict
+
+
+class TokenBuckets:
+    """Token bucket rate limits: each key may take `rate` tokens per
+    second with bursts of up to `burst`. Buckets of at most `max_keys`
+    keys are kept, the least recently used go first
+
+    """
+    def __init__(self,
+                 rate: float,
+                 burst: float = 0,
+                 max_keys: int = 1000,
+                 clock=time.monotonic):
+        self.rate = rate
+        self.burst = max(burst or rate, 1)
+        self.max_keys = max_keys
+        self.clock = clock
+        self.lock = threading.Lock()
+        # key -> [tokens, last refill]
+        self._buckets: OrderedDict = OrderedDict()
+
+    def take(self, key):
+        """Takes a token for `key`. Returns False if there is none left"""
+        with self.lock:
+            now = self.clock()
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                while len(self._buckets) >= self.max_keys:
+                    self._buckets.popitem(last=False)
+                bucket = self._buckets[key] = [self.burst, now]
+            else:
+                self._buckets.move_to_end(key)
+                bucket[0] = min(self.burst,
+                                bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+            if bucket[0] < 1:
+                return False
+            bucket[0] -= 1
+            return True
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+def _buckets(limit, clock):
+    """`TokenBuckets` for `limit`, a rate or [rate, burst], or None"""
+    if not limit:
+        return None
+    if isinstance(limit, (list, tuple)):
+        return TokenBuckets(limit[0], limit[1], clock=clock)
+    return TokenBuckets(limit, clock=clock)
+
+
+class AdmissionControl:
+    """Decides whether a request is handled or shed: each device and
+    each intent has to get a token from its `TokenBuckets` (limits are
+    a rate or [rate, burst]), and at most `max_in_flight` requests are
+    handled at the same time. Requests that were admitted have to be
+    `release`d when done
+
+    """
+    def __init__(self,
+                 device_limit=None,
+                 intent_limit=None,
+                 max_in_flight: int = 0,
+                 clock=time.monotonic):
+        self.devices = _buckets(device_limit, clock)
+        self.intents = _buckets(intent_limit, clock)
+        self.max_in_flight = max_in_flight
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.stats = {
+            'admitted': 0,
+            'shed_device': 0,
+            'shed_intent': 0,
+            'shed_in_flight': 0,
+            'peak_in_flight': 0
+        }
+
+    def admit(self, device, intent):
+        """Returns None if a request of `device` for `intent` may be
+        handled, otherwise the limit it hit: 'in_flight', 'device' or
+        'intent'
+
+        """
+        with self.lock:
+            if self.max_in_flight and self.in_flight >= self.max_in_flight:
+                reason = 'in_flight'
+            elif self.devices is not None and not self.devices.take(device):
+                reason = 'device'
+            elif (self.intents is not None and intent
+                  and not self.intents.take(intent)):
+                reason = 'intent'
+            else:
+                self.in_flight += 1
+                self.stats['admitted'] += 1
+                if self.in_flight > self.stats['peak_in_flight']:
+                    self.stats['peak_in_flight'] = self.in_flight
+                return None
+            self.stats['shed_' + reason] += 1
+            return reason
+
+    def release(self):
+        """Marks an admitted request as done"""
+        with self.lock:
+            self.in_flight -= 1
+
+    def get_stats(self):
+        """Returns the counters, the requests in flight and the number of
+        tracked devices and intents
+
+        """
+        with self.lock:
+            return dict(self.stats,
+                        in_flight=self.in_flight,
+                        devices=len(self.devices or ()),
+                        intents=len(self.intents or ()))
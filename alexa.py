@@ -18,9 +18,52 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 https://github.com/foorensic/appdaemon-alexa
 
 """
-from typing import Optional, Dict, List
+import re
+import threading
+import time
+from concurrent import futures
+from typing import Optional, Dict, List, Tuple
 import appdaemon.plugins.hass.hassapi as hassapi
+import admission
+import caches
+import devices
 import helpers
+import metrics
+import resolver
+import sessions
+import verification
+
+# Kinds of entries in the dispatch table
+DISPATCH_APP = 'app'  # Bound method of an intent app
+DISPATCH_BUILTIN = 'builtin'  # Our own fallback for a common intent
+DISPATCH_MISSING = 'missing'  # Nothing to call, entry holds the error
+
+# Intents we answer ourselves if there is no intent app for them
+BUILTIN_INTENTS = {
+    'AMAZON.StopIntent': 'builtin_stop',
+    'AMAZON.CancelIntent': 'builtin_stop',
+    'yesIntent': 'builtin_yes',
+    'AMAZON.YesIntent': 'builtin_yes',
+}
+
+# Configured phrase lists whose responses are prebuilt:
+# (arg, default, shouldEndSession)
+CANNED_PHRASES = [
+    ('conversationEnd', 'Bye', True),
+    ('conversationQuestion', 'What can I do?', False),
+    ('nextConversationQuestion', 'What else can I do?', False),
+    ('responseError', ['Error'], True),
+    ('intentTimeoutResponse', "I'm still working on it", True),
+    ('busyResponse', "I'm busy right now", True),
+]
+
+# The methods intent apps can implement
+APP_METHODS = ('launchRequest', 'intentStarted', 'intentInProgress',
+               'intentCompleted', 'canFulfill')
+
+
+class IntentTimeout(Exception):
+    """An intent app did not respond within its time budget"""
 
 
 class AlexaAPI(hassapi.Hass):
@@ -28,152 +71,466 @@ class AlexaAPI(hassapi.Hass):
     def initialize(self):
         """App init"""
         self.register_endpoint(self.api_call, 'alexa')
-        self.sessions: Dict[str, Dict] = {}
+        # Per-request chatter is DEBUG, each request gets one summary
+        # record at INFO
+        self.request_log = metrics.RequestLogger(
+            self.log,
+            level=self.args.get('logLevel', 'INFO'),
+            sample_rate=self.args.get('logSampleRate', 1),
+            summary=self.args.get('logSummary', True))
+        # Phase latencies and counters, see `get_stats`
+        self.metrics = metrics.Metrics()
+        self.register_endpoint(self.stats_call, 'alexa_stats')
+        interval = self.args.get('statsSensorInterval', 0)
+        if interval:
+            self.run_every(self.publish_stats, 'now', interval)
+        # AppDaemon initializes the app again when its config changes,
+        # so this picks up changed `devices`. Unknown devices are logged
+        # once, so they can be added to the config
+        self.devices = devices.DeviceRegistry(
+            self.args.get('devices') or {},
+            on_unknown=lambda device_id: self.request_log.info(
+                'Request from device: %s', device_id))
+        # Sessions can be kept in a database to survive restarts, or on a
+        # server to share them with other instances
+        backend = None
+        if self.args.get('sessionServer'):
+            host, _, port = self.args['sessionServer'].partition(':')
+            backend = sessions.RespSessionBackend(
+                sessions.RespClient(host, int(port or 6379)),
+                ttl=self.args.get('sessionTimeout', 300),
+                prefix=self.args.get('sessionKeyPrefix', 'alexa:session:'))
+        elif self.args.get('sessionDatabase'):
+            backend = sessions.SqliteSessionBackend(
+                self.args['sessionDatabase'])
+        self.sessions = sessions.SessionStore(
+            ttl=self.args.get('sessionTimeout', 300),
+            max_sessions=self.args.get('maxSessions', 1000),
+            max_requests=self.args.get('maxSessionRequests', 20),
+            backend=backend,
+            on_error=lambda err: self.request_log.error(
+                'ERROR: Session backend failed, keeping sessions in '
+                'memory: %s', err))
+        if backend is not None:
+            self.run_every(self.compact_sessions, 'now',
+                           self.args.get('sessionCompactInterval', 600))
+
+        self.build_canned_responses()
+
+        # Answers to CanFulfillIntentRequests, by intent and slots
+        ttls = self.args.get('canFulfillCache', 0)
+        self.can_fulfill_ttls = ttls if isinstance(ttls, dict) else {
+            'default': ttls
+        }
+        self.can_fulfill_cache = caches.TTLCache(
+            max_entries=self.args.get('canFulfillCacheSize', 1000))
+
+        # (app name, method) -> (kind, target), see `get_handler`
+        self.dispatch: Dict[Tuple[str, str], Tuple] = {}
+        self.dispatch_stats = {'hits': 0, 'misses': 0, 'invalidations': 0}
+        # Required handlers that could not be resolved yet
+        self.unresolved: set = set()
+        # The `launchRequestApp` and the `intents`
+        self.configured_apps: set = set()
+        # Entries hold bound methods of the intent apps, so they
+        # have to go when AppDaemon reloads or stops an app
+        self.listen_event(self.on_app_changed,
+                          'app_initialized',
+                          namespace='admin')
+        self.listen_event(self.on_app_changed,
+                          'app_terminated',
+                          namespace='admin')
+
+        # Optional time budget for the intent apps. Apps are then
+        # called on a worker pool, so we can answer Alexa in time
+        # while a slow app finishes in the background
+        timeouts = self.args.get('intentTimeout', 0)
+        if not isinstance(timeouts, dict):
+            timeouts = dict.fromkeys(APP_METHODS, timeouts)
+        self.intent_timeouts = {
+            method: float(timeout)
+            for method, timeout in timeouts.items() if timeout
+        }
+        self.executor = None
+        if self.intent_timeouts:
+            self.executor = futures.ThreadPoolExecutor(
+                max_workers=self.args.get('intentWorkers', 4),
+                thread_name_prefix='alexa-intent')
+        # intent app -> number of times it ran out of time, updated by
+        # the request threads under `deadline_lock`
+        self.deadline_stats: Dict[str, int] = {}
+        self.deadline_lock = threading.Lock()
+
+        # Responses by request id, to answer retries by Alexa. A retry
+        # of a request still being handled waits for it, but only as
+        # long as the apps may take, and always less than the 8 seconds
+        # Alexa waits for the retry
+        self.responses = None
+        if self.args.get('retryWindow', 30):
+            self.responses = caches.ResponseCache(
+                ttl=self.args.get('retryWindow', 30),
+                max_entries=self.args.get('retryCacheSize', 1000),
+                wait_timeout=self.args.get(
+                    'retryWaitTimeout',
+                    min(max(self.intent_timeouts.values(), default=6), 6)))
+
+        # Requests older than `requestMaxAge` seconds are rejected
+        self.request_max_age = self.args.get('requestMaxAge', 0)
+        self.verify_stats = {'rejected': 0}
+
+        # Admission control: token buckets per device and per intent
+        # (requests per second, burst) and a limit for the requests
+        # handled at the same time. Disabled unless configured
+        self.admission = None
+        if any(
+                self.args.get(arg) for arg in
+            ['deviceRateLimit', 'intentRateLimit', 'maxInFlight']):
+            self.admission = admission.AdmissionControl(
+                device_limit=self.args.get('deviceRateLimit'),
+                intent_limit=self.args.get('intentRateLimit'),
+                max_in_flight=self.args.get('maxInFlight', 0))
+
+        # Apps read states through `request.states`, each entity read
+        # once per turn, optionally reused for `stateCacheTtl` seconds
+        # within a session
+        self.state_cache_ttl = self.args.get('stateCacheTtl', 0)
+        self.state_stats = {'reads': 0, 'fetches': 0, 'session_hits': 0}
+        if self.state_cache_ttl:
+            # Sessions outlive the states they keep, a domain or all
+            # states are too big to stay around until the next turn
+            self.run_every(self.expire_states, 'now', 1)
 
-    def api_call(self, data, kwargs):
+        # Fuzzy matching of slot values to entity names and
+        # `entityAliases` for the apps, as `request.entities`. The index
+        # is built on the first lookup, renamed, new and removed
+        # entities update it
+        self.entities = None
+        if self.args.get('entityResolver', True):
+            self.entities = resolver.EntityResolver(
+                domains=self.args.get('resolverDomains'),
+                load=self.load_entities)
+            self.listen_state(self.on_entity_renamed,
+                              attribute='friendly_name')
+
+        self.prewarm()
+
+    def terminate(self):
+        """App shutdown"""
+        if self.executor:
+            self.executor.shutdown(wait=False)
+        if self.sessions.backend is not None:
+            self.sessions.backend.close()
+
+    def compact_sessions(self, kwargs):  # pylint: disable=unused-argument
+        """Drops expired sessions from the session database"""
+        self.request_log.info('Compacted sessions, %d expired',
+                              self.sessions.compact())
+
+    def expire_states(self, kwargs):  # pylint: disable=unused-argument
+        """Drops the states kept in the sessions beyond `stateCacheTtl`"""
+        now = time.monotonic()
+        for session in self.sessions.values():
+            helpers.StateSnapshot.expire(session, self.state_cache_ttl, now)
+
+    def api_call(self, data, kwargs):  # pylint: disable=unused-argument
         """Entrypoint of REST call"""
-        self.log('New Alexa API request')
+        self.request_log.begin()
+        response = self.route_request(data)
+        self.request_log.end(response[1])
+        return response
+
+    def route_request(self, data):
+        """Passes the request in `data` on to `process_request`, unless
+        it fails verification or is a retry of one we already answered
+
+        """
+        self.request_log.debug('New Alexa API request')
+        error = None
+        if self.request_max_age:
+            error = self.verify_request(data)
+        if error:
+            self.verify_stats['rejected'] += 1
+            self.request_log.warning('Rejecting request: %s', error)
+            self.request_log.note(outcome='rejected')
+            return {}, 400
         session_id = data.get('session', {}).get('sessionId', None)
         # Note that the session object is missing in AudioPlayer,
         # VideoApp, or PlaybackController requests
         if not session_id:
-            self.log('Request is missing session.sessionId!')
+            self.request_log.warning('Request is missing session.sessionId!')
+            self.request_log.note(outcome='rejected')
             return {}, 400
-
-        # Record the request
+        self.request_log.note(session=session_id)
+        # Parsed once, as parsing also counts the request of the device
+        started = time.perf_counter()
         request_data = self.get_request_data_from_json(data)
-        if session_id not in self.sessions:
-            self.log('New session: %s' % session_id)
-            self.sessions[session_id] = {'requests': list()}
-        self.sessions[session_id]['requests'].append(request_data)
+        parse_time = time.perf_counter() - started
 
-        # Handle request
-        return self.handle_request(session_id)
+        # Alexa retries requests it got no timely answer for. Those get
+        # the answer of the first attempt instead of running twice
+        request_id = (data.get('request') or {}).get('requestId')
+        if not request_id or self.responses is None:
+            return self.process_request(session_id, data, request_data,
+                                        parse_time)
+        # Stays 'retry' if the answer came from the cache
+        self.request_log.note(outcome='retry')
+        response = self.responses.get_or_run(
+            request_id, lambda: self.process_request(
+                session_id, data, request_data, parse_time))
+        if response is None:
+            self.request_log.info('Request %s is still being handled',
+                                  request_id)
+            self.request_log.note(outcome='in_progress')
+            return self.phrase_response(
+                helpers.random_pick(
+                    self.args.get('intentTimeoutResponse',
+                                  "I'm still working on it")),
+                request_data, True), 200
+        return response
 
-    def get_request_data_from_json(self, data):
-        """Extract the info we need from the data dict. Returns new dict with
-        our desired fields
+    def verify_request(self, data):
+        """Returns why the request in `data` failed verification, None if
+        it passed
 
         """
-        # Any error?
-        error = data.get('request', {}).get('error', {}).get('message', '')
-
-        # Get a proper device name
-        device_id = data.get('context',
-                             {}).get('System',
-                                     {}).get('device',
-                                             {}).get('deviceId',
-                                                     '<no_device_id>')
-        device = self.args.get('devices', {}).get(device_id, 'unknown device')
-        # Log the device if not yet known
-        if device_id not in self.args.get('devices', {}):
-            self.log('Request from device: %s' % device_id)
-
-        # The slots for this intent
-        slots = {}
-        for slot_value in data.get('request', {}).get('intent',
-                                                      {}).get('slots',
-                                                              {}).values():
-            slots[slot_value.get('name')] = {
-                'value': slot_value.get('value'),
-                'resolutions': []
-            }
-            # Add the 'resolutions' flattened. Let's hope thats enough
-            for resolution in slot_value.get('resolutions',
-                                             {}).get('resolutionsPerAuthority',
-                                                     []):
-                if resolution.get('status', {}).get('code',
-                                                    '') != 'ER_SUCCESS_MATCH':
-                    continue
-                for rpa_value in resolution.get('values', []):
-                    slots[slot_value.get('name')]['resolutions'].append({
-                        'id':
-                        rpa_value.get('value', {}).get('id', ''),
-                        'name':
-                        rpa_value.get('value', {}).get('name', '')
-                    })
-
-        # The intent name. Note some amazon intents are named like AMAZON.Intent
-        intent = data.get('request', {}).get('intent', {}).get('name', '')
-        confirmation_status = data.get('request',
-                                       {}).get('intent',
-                                               {}).get('confirmationStatus',
-                                                       'NONE')
+        try:
+            verification.check_timestamp(
+                (data.get('request') or {}).get('timestamp'),
+                self.request_max_age, time.time())
+        except verification.RequestVerificationError as err:
+            return str(err)
+        return None
+
+    def process_request(self, session_id, data, request_data, parse_time):
+        """Records `request_data`, parsed from `data` in `parse_time`
+        seconds, in its session and handles it
+
+        """
+        parsed = time.perf_counter()
+        self.request_log.note(type=request_data.type,
+                              intent=request_data.intent,
+                              phase=request_data.dialog_state,
+                              outcome='ok')
+        # Bursts are shed before they create sessions or reach apps.
+        # SessionEndedRequests only clean up, so they always pass
+        if (self.admission is not None
+                and request_data.type != 'SessionEndedRequest'):
+            reason = self.admission.admit(devices.device_id(data),
+                                          request_data.intent)
+            if reason is None:
+                try:
+                    response = self.handle_turn(session_id, request_data)
+                finally:
+                    self.admission.release()
+            else:
+                response = self.busy_response(request_data, reason)
+        else:
+            response = self.handle_turn(session_id, request_data)
+        handled = time.perf_counter()
+        self.metrics.count(request_data, 'requests')
+        self.metrics.observe(request_data, 'parse', parse_time)
+        self.metrics.observe(request_data, 'handle', handled - parsed)
+        self.metrics.observe(request_data, 'total',
+                             parse_time + handled - parsed)
+        return response
+
+    def handle_turn(self, session_id, request_data):
+        """Handles `request_data` within its session"""
+        # CanFulfillIntentRequests are no part of a dialog
+        if request_data.type == 'CanFulfillIntentRequest':
+            request_data.states = helpers.StateSnapshot(
+                self.get_state, self.state_stats)
+            return self.handle_request(session_id, request_data)
+        # Turns of a session are handled one at a time, but a turn
+        # only waits for the previous one (or a late app call of it)
+        # as long as its own app may take
+        method = self.app_method(request_data)
+        if method is None:
+            timeout = max(self.intent_timeouts.values(), default=None)
+        else:
+            timeout = self.intent_timeouts.get(method)
+        try:
+            with self.sessions.locked(session_id, timeout) as session:
+                self.sessions.append(session_id, session, request_data)
+                if len(session['requests']) == 1:
+                    self.request_log.debug('New session: %s', session_id)
+                request_data.states = helpers.StateSnapshot(
+                    self.get_state, self.state_stats, session,
+                    self.state_cache_ttl)
+
+                # Handle request
+                try:
+                    return self.handle_request(session_id, request_data)
+                finally:
+                    self.end_turn(session, request_data)
+        except sessions.SessionBusy:
+            self.request_log.error(
+                'ERROR: Session %s still busy with its previous turn after %ss',
+                session_id, timeout)
+            self.metrics.count(request_data, 'timeouts')
+            self.request_log.note(outcome='timeout')
+            return self.timeout_response(method, request_data)
+
+    @staticmethod
+    def app_method(request):
+        """The intent app method `handle_request` calls for the dialog
+        turn `request`, None if it calls none
+
+        """
+        if request.type == 'LaunchRequest':
+            return 'launchRequest'
+        if request.type == 'IntentRequest':
+            return {
+                'STARTED': 'intentStarted',
+                'IN_PROGRESS': 'intentInProgress',
+                'COMPLETED': 'intentCompleted'
+            }.get(request.dialog_state)
+        return None
+
+    @staticmethod
+    def end_turn(session, request):
+        """Drops what only the turn of `request` needed, once it and an
+        app call still running for it are done. The next turn of
+        `session` waits for such a call, within its own time budget
+
+        """
+        pending, request.pending = request.pending, None
+        if pending is None:
+            # The snapshot must not stay with the turn kept in the session
+            request.states = None
+            return
+        session['pending'] = pending
+        pending.add_done_callback(lambda _: setattr(request, 'states', None))
+
+    def busy_response(self, request, reason):
+        """Response for a request shed by admission control"""
+        self.request_log.info('Shedding %s request (%s limit)', request.type,
+                              reason)
+        self.metrics.count(request, 'shed')
+        self.request_log.note(outcome='shed_%s' % reason)
+        if request.type == 'CanFulfillIntentRequest':
+            return self.canned['empty'], 200
+        return self.phrase_response(
+            helpers.random_pick(
+                self.args.get('busyResponse', "I'm busy right now")), request,
+            True), 200
+
+    def stats_call(self, data, kwargs):  # pylint: disable=unused-argument
+        """Entrypoint of REST call for the stats"""
+        return self.get_stats(), 200
+
+    def get_stats(self):
+        """Returns the latency histograms, counters and cache stats"""
+        with self.deadline_lock:
+            deadlines = dict(self.deadline_stats)
         return {
-            'type': data.get('request', {}).get('type', ''),
-            'intent': intent,
-            'confirmation_status': confirmation_status,
-            'dialog_state': data.get('request', {}).get('dialogState', ''),
-            'device': device,
-            'slots': slots,
-            'error': error
+            'sessions': self.sessions.get_stats(),
+            'dispatch': dict(self.dispatch_stats),
+            'deadlines': deadlines,
+            'retries': (self.responses.get_stats()
+                        if self.responses is not None else {}),
+            'can_fulfill': self.can_fulfill_cache.get_stats(),
+            'devices': self.devices.get_stats(),
+            'entities': (self.entities.get_stats()
+                         if self.entities is not None else {}),
+            'verification': dict(self.verify_stats),
+            'prewarm': dict(self.prewarm_stats,
+                            missing=sorted('%s.%s' % key
+                                           for key in self.unresolved)),
+            'admission': (self.admission.get_stats()
+                          if self.admission is not None else {}),
+            'states': dict(self.state_stats,
+                           avoided=self.state_stats['reads'] -
+                           self.state_stats['fetches']),
+            'requests': self.metrics.snapshot()
         }
 
+    def publish_stats(self, kwargs):  # pylint: disable=unused-argument
+        """Publishes the latencies per request type/intent as sensors in
+        Home Assistant, with the total p95 in ms as state
+
+        """
+        for name, entry in self.metrics.snapshot().items():
+            if 'total' not in entry:
+                continue
+            attributes = dict(entry['total'], **entry.get('counters', {}))
+            attributes['unit_of_measurement'] = 'ms'
+            self.set_state('sensor.alexa_latency_%s' %
+                           re.sub(r'[^a-z0-9]+', '_', name.lower()),
+                           state=entry['total']['p95_ms'],
+                           attributes=attributes)
+
+    def get_request_data_from_json(self, data):
+        """Extract the info we need from the data dict. Returns a new
+        `helpers.Request` record with our desired fields
+
+        """
+        request = helpers.parse_request(data, self.devices.name)
+        request.entities = self.entities
+        return request
+
     # pylint: disable=too-many-return-statements,too-many-branches
-    def handle_request(self, session_id):
-        """Handle latest request for `session_id`"""
-        # Get the latest request in the session
-        request = self.sessions[session_id]['requests'][-1]
+    def handle_request(self, session_id, request):
+        """Handle `request`, the latest request for `session_id`"""
 
         # There are 4 different standard request types we handle
         if request['type'] == 'LaunchRequest':
-            self.log('LaunchRequest')
+            self.request_log.debug('LaunchRequest')
             # Sent when the user invokes your skill without providing
             # a specific intent.
             #
             # https://developer.amazon.com/en-US/docs/alexa/custom-skills/request-types-reference.html#launchrequest
             return self.get_app_response(self.args.get('launchRequestApp', ''),
-                                         'launchRequest', session_id)
+                                         'launchRequest', session_id,
+                                         request)
 
         if request['type'] == 'IntentRequest':
-            self.log('IntentRequest: %s' % request['intent'])
+            self.request_log.debug('IntentRequest: %s', request['intent'])
             # Sent when the user makes a request that corresponds to
             # one of the intents defined in your intent schema.
             #
             # https://developer.amazon.com/en-US/docs/alexa/custom-skills/request-types-reference.html#intentrequest
             if not request['dialog_state']:
-                self.log(
+                self.request_log.debug(
                     'Dialog not yet started (or intent has no dialog model, i.e. no multi-turn dialog)'
                 )
                 # TODO: Not sure how this works. Do we delegate this
                 # request to a method in the intent app?
-                return self.create_response_dict(shouldEndSession=True), 200
+                return self.canned['end'], 200
             if request['dialog_state'] == 'STARTED':
-                self.log('Dialog started')
+                self.request_log.debug('Dialog started')
                 # Dialog started, let's give the app a chance to respond, or we delegate back to Alexa
                 try:
                     return self.get_app_response(request['intent'],
                                                  'intentStarted',
                                                  session_id,
+                                                 request,
                                                  error_exception=True)
                 except Exception:  # pylint: disable=broad-except
-                    self.log(
-                        'Failed to ask %s for %s. Delegating dialog to Alexa' %
-                        (request['intent'], 'intentStarted'))
-                return self.create_response_dict(
-                    directives=[{
-                        'type': 'Dialog.Delegate',
-                        'updatedIntent': None
-                    }]), 200
+                    self.request_log.warning(
+                        'Failed to ask %s for %s. Delegating dialog to Alexa',
+                        request['intent'], 'intentStarted')
+                    self.metrics.count(request, 'fallbacks')
+                    self.request_log.note(outcome='delegated')
+                return self.canned['delegate'], 200
             if request['dialog_state'] == 'IN_PROGRESS':
-                self.log('Dialog in progress')
+                self.request_log.debug('Dialog in progress')
                 # Dialog started, let's give the app a chance to respond, or we delegate back to Alexa
                 try:
                     return self.get_app_response(request['intent'],
                                                  'intentInProgress',
                                                  session_id,
+                                                 request,
                                                  error_exception=True)
                 except Exception:  # pylint: disable=broad-except
-                    self.log(
-                        'Failed to ask %s for %s: Delegating dialog to Alexa' %
-                        (request['intent'], 'intentInProgress'))
-                return self.create_response_dict(
-                    directives=[{
-                        'type': 'Dialog.Delegate',
-                        'updatedIntent': None
-                    }]), 200
+                    self.request_log.warning(
+                        'Failed to ask %s for %s: Delegating dialog to Alexa',
+                        request['intent'], 'intentInProgress')
+                    self.metrics.count(request, 'fallbacks')
+                    self.request_log.note(outcome='delegated')
+                return self.canned['delegate'], 200
             if request['dialog_state'] == 'COMPLETED':
-                self.log('Dialog completed')
+                self.request_log.debug('Dialog completed')
                 # COMPLETED can either be because the dialog is really
                 # completed in which case we dispatch to the app, or
                 # there are dialog confirmation rules in which case
@@ -181,54 +538,114 @@ class AlexaAPI(hassapi.Hass):
                 # user confirmed or denied the entire intent. So we
                 # check that the user did not deny the confirmation
                 if request['confirmation_status'] == 'DENIED':
-                    self.log('User denied the intent. Aborting session')
+                    self.request_log.debug(
+                        'User denied the intent. Aborting session')
+                    self.request_log.note(outcome='denied')
                     self.clean_session(session_id)
-                    return self.create_response_dict(
-                        shouldEndSession=True), 200
-                self.log('Calling user intent app %s' % request['intent'])
+                    return self.canned['end'], 200
+                self.request_log.debug('Calling user intent app %s',
+                                       request['intent'])
                 return self.get_app_response(request['intent'],
-                                             'intentCompleted', session_id)
+                                             'intentCompleted', session_id,
+                                             request)
 
-            self.log('Dialog state is %s - this should not happen!' %
-                     request['dialog_state'])
-            return self.create_response_dict(), 200
+            self.request_log.warning(
+                'Dialog state is %s - this should not happen!',
+                request['dialog_state'])
+            return self.canned['empty'], 200
 
         if request['type'] == 'SessionEndedRequest':
-            self.log('SessionEndedRequest')
+            self.request_log.debug('SessionEndedRequest')
             # Sent when the current skill session ends for any reason
             # other than your code closing the session.
             #
             # https://developer.amazon.com/en-US/docs/alexa/custom-skills/request-types-reference.html#sessionendedrequest
-            self.log('Alexa says session %s has ended: %s' %
-                     (session_id, request['error']))
+            self.request_log.debug('Alexa says session %s has ended: %s',
+                                   session_id, request['error'])
             self.clean_session(session_id)
-            return self.create_response_dict(), 200
+            return self.canned['empty'], 200
 
         if request['type'] == 'CanFulfillIntentRequest':
-            self.log('CanFulfillIntentRequest')
+            self.request_log.debug('CanFulfillIntentRequest')
             # Sent when the Alexa service is querying a skill to
             # determine whether the skill can understand and fulfill
             # the intent request with detected slots, before actually
             # asking the skill to take action.
             #
             # https://developer.amazon.com/en-US/docs/alexa/custom-skills/request-types-reference.html#CanFulfillIntentRequest
+            #
+            # The answers are cached for the configured intents,
+            # Alexa asks again and again
+            ttl = self.can_fulfill_ttls.get(
+                request['intent'], self.can_fulfill_ttls.get('default', 0))
+            if ttl:
+                key = caches.can_fulfill_key(request)
+                response = self.can_fulfill_cache.get(key)
+                if response is not None:
+                    self.request_log.note(outcome='cached')
+                    return response
             try:
-                return self.get_app_response(request['intent'],
-                                             'canFulfill',
-                                             session_id,
-                                             error_exception=True)
+                response = self.get_app_response(request['intent'],
+                                                 'canFulfill',
+                                                 session_id,
+                                                 request,
+                                                 error_exception=True)
             except Exception:  # pylint: disable=broad-except
-                self.log(
-                    'Failed to ask %s for %s: Delegating dialog to Alexa' %
-                    (request['intent'], 'intentInProgress'))
-            return self.create_response_dict(), 200
+                self.request_log.warning(
+                    'Failed to ask %s for %s: Delegating dialog to Alexa',
+                    request['intent'], 'canFulfill')
+                self.metrics.count(request, 'fallbacks')
+                self.request_log.note(outcome='delegated')
+                return self.canned['empty'], 200
+            if ttl:
+                self.can_fulfill_cache.set(key, response, ttl)
+            return response
 
         # TODO: Non-standard request type or other interface request
         # need to be implemented
-        self.log('Non-standard request we cannot handle yet')
+        self.request_log.warning('Non-standard request we cannot handle yet')
         self.clean_session(session_id)
         return self.plain_error(request)
 
+    def build_canned_responses(self):
+        """Prebuilds the responses that do not depend on the request: the
+        plain acknowledgments and the ones speaking a configured phrase
+        without placeholders. They are shared, so never modify them
+
+        """
+        self.canned = {
+            'empty':
+            self.create_response_dict(),
+            'end':
+            self.create_response_dict(shouldEndSession=True),
+            'delegate':
+            self.create_response_dict(directives=[{
+                'type': 'Dialog.Delegate',
+                'updatedIntent': None
+            }])
+        }
+        for arg, default, end_session in CANNED_PHRASES:
+            phrases = self.args.get(arg, default)
+            for phrase in phrases if isinstance(phrases, list) else [phrases]:
+                if not phrase or helpers.compile_speech(phrase).names:
+                    continue
+                self.canned[(phrase, end_session)] = self.create_response_dict(
+                    outputSpeech={
+                        'type': 'SSML',
+                        'ssml': '<speak>' +
+                        helpers.compile_speech(phrase).literals[0] + '</speak>'
+                    },
+                    shouldEndSession=end_session)
+
+    def phrase_response(self, phrase, request, shouldEndSession):  # pylint: disable=invalid-name
+        """Returns the response speaking `phrase`, prebuilt if possible"""
+        response = self.canned.get((phrase, shouldEndSession))
+        if response is None:
+            response = self.create_response_dict(
+                outputSpeech=self.get_simple_outputSpeech(phrase, request),
+                shouldEndSession=shouldEndSession)
+        return response
+
     # pylint: disable=too-many-arguments,no-self-use,invalid-name
     def create_response_dict(self,
                              outputSpeech: Optional[Dict] = None,
@@ -269,70 +686,64 @@ class AlexaAPI(hassapi.Hass):
         """Prepares speech text by cleaning up and replacing slots"""
         if not text:
             return text
-        for slotname, slotvalue in request['slots'].items():
-            text = text.replace("{{" + slotname + "}}",
-                                slotvalue.get('value', '') or '')
-        return text.replace("{{device}}",
-                            request['device']).replace("_", " ").replace(
-                                "...", "<break time='2s'/>")
+        return helpers.compile_speech(text).render(request['slots'],
+                                                    request['device'])
 
     def get_app_response(self,
                          app_name,
                          method,
                          session_id,
+                         request,
                          error_exception=False):
         """Asks an app `app_name` for a response by calling `method(request`
         to it. `error_exception` raises an exception instead or returning an
         Alexa compatible error response
 
         """
-        request = self.sessions[session_id]['requests'][-1]
-        app = self.get_app(app_name)
-        if not app:
-            # If the app was not found, we implement a better response
-            # for some default/common intent requests. This allows for
-            # better expected behaviour while the user can still
-            # override by creating an intent app for it
-            if app_name in ['AMAZON.StopIntent', 'AMAZON.CancelIntent']:
-                self.clean_session(session_id)
-                return self.create_response_dict(
-                    outputSpeech=self.get_simple_outputSpeech(
-                        helpers.random_pick(
-                            self.args.get('conversationEnd', 'Bye')), request),
-                    shouldEndSession=True), 200
-            if app_name in ['yesIntent', 'AMAZON.YesIntento']:
-                # If configured and not overridden, we assume user
-                # responded 'yes' to a question 'nextConversationQuestion'
-                return self.create_response_dict(
-                    outputSpeech=self.get_simple_outputSpeech(
-                        helpers.random_pick(
-                            self.args.get('conversationQuestion',
-                                          'What can I do?')), request),
-                    shouldEndSession=False), 200
-            self.log('App not found: %s' % app_name)
-            if error_exception:
-                raise Exception('App not found: %s' % app_name)
-            return self.plain_error(request)
-
-        if not (hasattr(app, method) and callable(getattr(app, method))):
-            self.log(
-                'Requested property %s of app %s is not callable or does not exist!'
-                % (method, app_name))
+        kind, target = self.get_handler(app_name, method)
+        if kind == DISPATCH_BUILTIN:
+            self.metrics.count(request, 'fallbacks')
+            self.request_log.note(outcome='fallback')
+            return target(request, session_id)
+        if kind == DISPATCH_MISSING:
+            self.request_log.warning(target)
             if error_exception:
-                raise Exception(
-                    'Requested property %s of app %s is not callable or does not exist!'
-                    % (method, app_name))
+                raise Exception(target)
             return self.plain_error(request)
 
+        started = time.perf_counter()
         try:
-            app_response = getattr(app, method)(request)
+            app_response = self.call_app(app_name, method, target, request)
+        except IntentTimeout as err:
+            self.request_log.error('ERROR: %s', err)
+            self.metrics.count(request, 'timeouts')
+            self.request_log.note(outcome='timeout')
+            return self.timeout_response(method, request)
         except Exception as err:  # pylint: disable=broad-except
-            self.log('ERROR: Exception calling intent app %s: %s' %
-                     (app_name, str(err)))
+            self.request_log.error(
+                'ERROR: Exception calling intent app %s: %s', app_name,
+                err)
             if error_exception:
                 raise err
             return self.plain_error(request)
+        finally:
+            called = time.perf_counter()
+            self.metrics.observe(request, 'app', called - started)
+
+        response = self.create_app_response(app_name, app_response, request,
+                                            error_exception)
+        self.metrics.observe(request, 'response',
+                             time.perf_counter() - called)
+        return response
+
+    # pylint: disable=too-many-return-statements
+    def create_app_response(self, app_name, app_response, request,
+                            error_exception):
+        """Turns the return value of an intent app into the response for
+        Alexa. `error_exception` raises an exception instead or returning
+        an Alexa compatible error response
 
+        """
         # For the app response we accept 5 variants, depending on
         # whether or not the app needs a custom response:
         #
@@ -388,35 +799,33 @@ class AlexaAPI(hassapi.Hass):
                             self.args.get('conversationEnd', 'Bye'))
                         if value1:
                             message = value1 + '. ' + message
-                        return self.create_response_dict(
-                            outputSpeech=self.get_simple_outputSpeech(
-                                message, request),
-                            shouldEndSession=True), 200
+                        return self.phrase_response(message, request,
+                                                    True), 200
                     if value2 == 'next':
                         message = helpers.random_pick(
                             self.args.get('nextConversationQuestion',
                                           'What else can I do?'))
                         if value1:
                             message = value1 + '. ' + message
-                        return self.create_response_dict(
-                            outputSpeech=self.get_simple_outputSpeech(
-                                message, request),
-                            shouldEndSession=False), 200
+                        return self.phrase_response(message, request,
+                                                    False), 200
 
                     # Fallback to variant 1
                     return self.create_response_dict(
                         outputSpeech=self.get_simple_outputSpeech(
                             value1, request)), 200
 
-                self.log('App %s returned tuple of unknown type combination' %
-                         app_name)
+                self.request_log.error(
+                    'App %s returned tuple of unknown type combination',
+                    app_name)
                 if error_exception:
                     raise Exception(
                         'App %s returned tuple of unknown type combination' %
                         app_name)
                 return self.plain_error(request)
 
-            self.log('App %s returned too many values in tuple' % app_name)
+            self.request_log.error('App %s returned too many values in tuple',
+                                   app_name)
             if error_exception:
                 raise Exception('App %s returned too many values in tuple' %
                                 app_name)
@@ -439,23 +848,224 @@ class AlexaAPI(hassapi.Hass):
                                                   False)), 200
 
         # If we get here, we have unknown return value(s) from the app
-        self.log('App %s returned unknown value(s)' % app_name)
+        self.request_log.error('App %s returned unknown value(s)', app_name)
         if error_exception:
             raise Exception('App %s returned unknown value(s)' % app_name)
         return self.plain_error(request)
 
+    def prewarm(self):
+        """Resolves the handlers we know we need and compiles the speech
+        templates of the configured phrases, so the first requests do not
+        pay for it. Logs one summary naming the missing handlers
+
+        """
+        started = time.perf_counter()
+        self.unresolved = self.build_dispatch_table()
+        templates = 0
+        for arg, default, _ in CANNED_PHRASES:
+            phrases = self.args.get(arg, default)
+            for phrase in phrases if isinstance(phrases, list) else [phrases]:
+                if phrase:
+                    helpers.compile_speech(phrase)
+                    templates += 1
+        self.prewarm_stats = {
+            'ms': round((time.perf_counter() - started) * 1000, 3),
+            'handlers': len(self.dispatch),
+            'templates': templates,
+            'missing': sorted('%s.%s' % key for key in self.unresolved)
+        }
+        if self.unresolved:
+            self.request_log.warning(
+                'Prewarmed %d handlers and %d speech templates in %.1f ms, '
+                'missing: %s', self.prewarm_stats['handlers'], templates,
+                self.prewarm_stats['ms'],
+                ', '.join(self.prewarm_stats['missing']))
+        else:
+            self.request_log.info(
+                'Prewarmed %d handlers and %d speech templates in %.1f ms',
+                self.prewarm_stats['handlers'], templates,
+                self.prewarm_stats['ms'])
+
+    def build_dispatch_table(self):
+        """(Re)builds the dispatch table with the handlers we already know
+        we need: the `launchRequestApp`, the builtin intents and the
+        phase methods of the configured `intents`. Everything else is
+        added on first use. Returns the (app name, method) of the
+        required handlers that are missing
+
+        """
+        self.dispatch = {}
+        required = []
+        launch_app = self.args.get('launchRequestApp', '')
+        if launch_app:
+            required.append((launch_app, 'launchRequest'))
+        self.configured_apps = {app_name for app_name, _ in required}
+        self.configured_apps.update(self.args.get('intents') or [])
+        for intent in BUILTIN_INTENTS:
+            self.get_handler(intent, 'intentCompleted')
+        for intent in self.args.get('intents') or []:
+            required.append((intent, 'intentCompleted'))
+            # Apps may leave these out, Alexa then handles the phase
+            for method in ['intentStarted', 'intentInProgress', 'canFulfill']:
+                self.get_handler(intent, method)
+        return {
+            key
+            for key in required
+            if self.get_handler(*key)[0] == DISPATCH_MISSING
+        }
+
+    def get_handler(self, app_name, method):
+        """Returns the dispatch table entry for calling `method` of app
+        `app_name` as (kind, target) tuple. Resolves and caches the entry
+        if it is not in the table yet. Apps that are neither configured
+        nor running are not cached: their names come from requests, so
+        the table would grow with every made up intent
+
+        """
+        entry = self.dispatch.get((app_name, method))
+        if entry is not None:
+            self.dispatch_stats['hits'] += 1
+            return entry
+        self.dispatch_stats['misses'] += 1
+        entry = self.resolve_handler(app_name, method)
+        if (entry[0] != DISPATCH_MISSING or app_name in self.configured_apps
+                or self.get_app(app_name)):
+            self.dispatch[(app_name, method)] = entry
+        return entry
+
+    def resolve_handler(self, app_name, method):
+        """Looks up how to dispatch `method` of app `app_name`"""
+        app = self.get_app(app_name)
+        if not app:
+            # If the app was not found, we implement a better response
+            # for some default/common intent requests. This allows for
+            # better expected behaviour while the user can still
+            # override by creating an intent app for it
+            if app_name in BUILTIN_INTENTS:
+                return DISPATCH_BUILTIN, getattr(self,
+                                                 BUILTIN_INTENTS[app_name])
+            return DISPATCH_MISSING, 'App not found: %s' % app_name
+
+        handler = getattr(app, method, None)
+        if not callable(handler):
+            return DISPATCH_MISSING, (
+                'Requested property %s of app %s is not callable or does not exist!'
+                % (method, app_name))
+        return DISPATCH_APP, handler
+
+    def on_app_changed(self, event_name, data, kwargs):  # pylint: disable=unused-argument
+        """Drops the dispatch table entries of an app that was
+        (re)initialized or terminated by AppDaemon
+
+        """
+        app_name = (data or {}).get('app')
+        if not app_name or app_name == self.name:
+            return
+        self.dispatch = {
+            key: entry
+            for key, entry in self.dispatch.items() if key[0] != app_name
+        }
+        self.dispatch_stats['invalidations'] += 1
+        # Intent apps AppDaemon starts after this one were missing at
+        # the prewarm, check them again
+        if event_name != 'app_initialized':
+            return
+        for key in sorted(self.unresolved):
+            if key[0] == app_name and self.get_handler(
+                    *key)[0] != DISPATCH_MISSING:
+                self.unresolved.discard(key)
+                self.request_log.info('Handler %s.%s is available now', *key)
+
+    def load_entities(self):
+        """Indexes all entities for the entity resolver, which calls this
+        on its first lookup
+
+        """
+        self.entities.update_from_states(self.get_state(),
+                                         self.args.get('entityAliases'))
+
+    def on_entity_renamed(self, entity, attribute, old, new, kwargs):  # pylint: disable=unused-argument,too-many-arguments
+        """Updates the entity resolver when an entity got a new friendly
+        name, was added or removed
+
+        """
+        if new is None:
+            self.entities.remove(entity)
+        else:
+            self.entities.add(entity, [new] + list(
+                (self.args.get('entityAliases') or {}).get(entity, ())))
+
+    def builtin_stop(self, request, session_id):
+        """Default response for Stop/Cancel: say goodbye and end the session"""
+        self.clean_session(session_id)
+        return self.phrase_response(
+            helpers.random_pick(self.args.get('conversationEnd', 'Bye')),
+            request, True), 200
+
+    def builtin_yes(self, request, session_id):  # pylint: disable=unused-argument
+        """Default response for 'yes': If configured and not overridden, we
+        assume user responded 'yes' to a question 'nextConversationQuestion'
+
+        """
+        return self.phrase_response(
+            helpers.random_pick(
+                self.args.get('conversationQuestion', 'What can I do?')),
+            request, False), 200
+
+    def call_app(self, app_name, method, handler, request):
+        """Calls `handler(request)`, within the configured time budget for
+        `method` if there is one. Raises `IntentTimeout` if the app
+        takes longer. A call still waiting for a worker is cancelled, one
+        that already started finishes in the background and is left in
+        `request.pending`
+
+        """
+        timeout = self.intent_timeouts.get(method)
+        if not timeout:
+            return handler(request)
+        future = self.executor.submit(handler, request)
+        done, _ = futures.wait([future], timeout=timeout)
+        if done:
+            return future.result()
+
+        with self.deadline_lock:
+            self.deadline_stats[app_name] = self.deadline_stats.get(
+                app_name, 0) + 1
+        if future.cancel():
+            raise IntentTimeout(
+                'Intent app %s did not get a worker for %s within %ss' %
+                (app_name, method, timeout))
+        request.pending = future
+        future.add_done_callback(
+            lambda future: self.request_log.warning(
+                'Intent app %s finished %s after its deadline (%s)', app_name,
+                method,
+                future.exception() or 'ok'))
+        raise IntentTimeout('Intent app %s did not finish %s within %ss' %
+                            (app_name, method, timeout))
+
+    def timeout_response(self, method, request):
+        """Response for when an app ran out of time for `method`"""
+        if method in ['intentStarted', 'intentInProgress']:
+            return self.canned['delegate'], 200
+        if method == 'canFulfill':
+            return self.canned['empty'], 200
+        return self.phrase_response(
+            helpers.random_pick(
+                self.args.get('intentTimeoutResponse',
+                              "I'm still working on it")), request, True), 200
+
     def plain_error(self, request, message=None):
         """Shorthand for returning a plain error message"""
+        self.metrics.count(request, 'errors')
+        self.request_log.note(outcome='error')
         error_msg = message or helpers.random_pick(
             self.args.get("responseError", ['Error']))
-        return self.create_response_dict(
-            outputSpeech=self.get_simple_outputSpeech(error_msg, request),
-            shouldEndSession=True), 200
+        return self.phrase_response(error_msg, request, True), 200
 
     def clean_session(self, session_id):
         """Removes a session from the internal state"""
-        if session_id in self.sessions:
-            self.log('Cleaning up session %s' % session_id)
-            del self.sessions[session_id]
+        if self.sessions.pop(session_id):
+            self.request_log.debug('Cleaning up session %s', session_id)
             return True
         return False
@@ -0,0 +1,305 @@
+#!/usr/bin/env python
+"""harness.py -- Part of Alexa App for Appdaemon
+Copyright (C) 2021 foorensic
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+https://github.com/foorensic/appdaemon-alexa
+
+Runs `AlexaAPI` and `exampleIntent` outside of AppDaemon for the
+benchmarks. `StubHass` stands in for `hassapi.Hass` with just what the
+apps use, and the helpers below build Alexa requests and dialogs.
+
+"""
+import copy
+import json
+import os
+import random
+import sys
+import types
+import uuid
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+PAYLOADS = os.path.join(os.path.dirname(__file__), 'payloads.jsonl')
+
+
+class StubHass:
+    """In-process stand-in for `appdaemon.plugins.hass.hassapi.Hass`"""
+    def __init__(self, name, args, apps, states=None):
+        self.name = name
+        self.args = args
+        self.apps = apps
+        self.states = states if states is not None else {}
+        self.endpoints = {}
+        self.logs = []
+        self.keep_logs = False
+
+    def log(self, msg, *args, **kwargs):  # pylint: disable=unused-argument
+        """Drops the message unless `keep_logs` is set"""
+        if self.keep_logs:
+            self.logs.append(msg % args if args else msg)
+
+    def register_endpoint(self, callback, endpoint):
+        """Remembers the endpoint so the benchmark can call it"""
+        self.endpoints[endpoint] = callback
+
+    def get_app(self, name):
+        """Returns the app object of app `name` or None"""
+        return self.apps.get(name)
+
+    def get_state(self, entity_id=None, attribute=None, **kwargs):  # pylint: disable=unused-argument
+        """Returns the state of `entity_id` (or its `attribute`) from
+        `states`, or all states without an `entity_id`. Like AppDaemon,
+        it returns copies
+
+        """
+        if entity_id is None:
+            return copy.deepcopy(self.states)
+        state = self.states.get(entity_id)
+        if state is None:
+            return None
+        if attribute == 'all':
+            return copy.deepcopy(state)
+        if attribute:
+            return state.get('attributes', {}).get(attribute)
+        return state.get('state')
+
+    def set_state(self, entity_id, **kwargs):
+        """Stores the state in `states`"""
+        self.states[entity_id] = kwargs
+
+    def listen_event(self, *args, **kwargs):
+        """Events are not delivered"""
+
+    def listen_state(self, *args, **kwargs):
+        """State changes are not delivered"""
+
+    def run_every(self, *args, **kwargs):
+        """Timers do not fire"""
+
+    def run_in(self, *args, **kwargs):
+        """Timers do not fire"""
+
+
+def install_stub():
+    """Makes `import appdaemon.plugins.hass.hassapi` find `StubHass` and
+    puts the apps on the import path
+
+    """
+    if 'appdaemon.plugins.hass.hassapi' not in sys.modules:
+        hassapi = types.ModuleType('appdaemon.plugins.hass.hassapi')
+        hassapi.Hass = StubHass
+        for name in [
+                'appdaemon', 'appdaemon.plugins', 'appdaemon.plugins.hass'
+        ]:
+            sys.modules.setdefault(name, types.ModuleType(name))
+        sys.modules['appdaemon.plugins.hass.hassapi'] = hassapi
+        sys.modules['appdaemon.plugins.hass'].hassapi = hassapi
+    for path in [ROOT, os.path.join(ROOT, 'exampleIntent')]:
+        if path not in sys.path:
+            sys.path.insert(0, path)
+
+
+def load_apps(alexa_args=None, example_args=None, states=None):
+    """Creates and initializes `AlexaAPI` and `exampleIntent` as AppDaemon
+    would. Arguments default to the ones in the yaml files. Returns the
+    `AlexaAPI` instance
+
+    """
+    install_stub()
+    import yaml  # pylint: disable=import-outside-toplevel
+    import alexa  # pylint: disable=import-outside-toplevel
+    import exampleIntent  # pylint: disable=import-outside-toplevel
+
+    def yaml_args(path, name):
+        with open(os.path.join(ROOT, path)) as yaml_file:
+            args = yaml.safe_load(yaml_file)[name]
+        for key in ['module', 'class']:
+            args.pop(key, None)
+        return args
+
+    apps = {}
+    states = states if states is not None else {}
+    example = exampleIntent.exampleIntent(
+        'exampleIntent', example_args if example_args is not None else
+        yaml_args('exampleIntent/exampleIntent.yaml', 'exampleIntent'),
+        apps, states)
+    api = alexa.AlexaAPI(
+        'alexa', alexa_args
+        if alexa_args is not None else yaml_args('alexa.yaml', 'alexa'), apps,
+        states)
+    apps['exampleIntent'] = example
+    apps['alexa'] = api
+    example.initialize()
+    api.initialize()
+    return api
+
+
+def load_payloads(path=PAYLOADS):
+    """Returns the recorded requests grouped into dialogs by session id"""
+    dialogs = {}
+    with open(path) as payload_file:
+        for line in payload_file:
+            if line.strip():
+                data = json.loads(line)
+                dialogs.setdefault(data['session']['sessionId'],
+                                   []).append(data)
+    return list(dialogs.values())
+
+
+def renew_dialog(dialog):
+    """Returns a copy of the recorded `dialog` with fresh session and
+    request ids, so it can be replayed any number of times
+
+    """
+    session_id = 'amzn1.echo-api.session.%s' % uuid.uuid4()
+    dialog = copy.deepcopy(dialog)
+    for data in dialog:
+        data['session']['sessionId'] = session_id
+        data['request']['requestId'] = 'amzn1.echo-api.request.%s' % (
+            uuid.uuid4())
+    return dialog
+
+
+def make_request(session_id,
+                 request_type,
+                 intent=None,
+                 dialog_state=None,
+                 slots=None,
+                 confirmation_status='NONE',
+                 device_id='amzn1.ask.device.KITCHENECHO'):
+    """Builds an Alexa request. `slots` maps slot names to
+    (value, resolution id, resolution name) tuples, the resolution
+    being left out if the id is None
+
+    """
+    request = {
+        'type': request_type,
+        'requestId': 'amzn1.echo-api.request.%s' % uuid.uuid4(),
+        'timestamp': '2021-03-01T18:00:00Z',
+        'locale': 'en-US'
+    }
+    if intent:
+        request['intent'] = {
+            'name': intent,
+            'confirmationStatus': confirmation_status,
+            'slots': {}
+        }
+        for name, (value, resolution_id,
+                   resolution_name) in (slots or {}).items():
+            slot = {'name': name, 'value': value, 'confirmationStatus': 'NONE'}
+            if resolution_id is not None:
+                slot['resolutions'] = {
+                    'resolutionsPerAuthority': [{
+                        'authority': 'amzn1.er-authority.echo-sdk.ROOM',
+                        'status': {
+                            'code': 'ER_SUCCESS_MATCH'
+                        },
+                        'values': [{
+                            'value': {
+                                'name': resolution_name,
+                                'id': resolution_id
+                            }
+                        }]
+                    }]
+                }
+            request['intent']['slots'][name] = slot
+    if dialog_state:
+        request['dialogState'] = dialog_state
+    return {
+        'version': '1.0',
+        'session': {
+            'new': False,
+            'sessionId': session_id
+        },
+        'context': {
+            'System': {
+                'device': {
+                    'deviceId': device_id
+                }
+            }
+        },
+        'request': request
+    }
+
+
+# How synthetic dialogs end, with their weights
+DIALOG_ENDINGS = [('next', 4), ('stop', 2), ('denied', 1), ('abandoned', 2),
+                  ('unknown_intent', 1)]
+ROOMS = [('kitchen', 'Kitchen'), ('living_room', 'Living Room'),
+         ('bedroom', 'Bedroom'), ('office', 'Office')]
+
+
+def synthetic_dialog(rng=random, ending=None):
+    """Builds a multi-turn dialog: a launch request, the exampleIntent
+    going through STARTED, IN_PROGRESS and COMPLETED, then `ending`
+    (randomly picked from `DIALOG_ENDINGS` if not given)
+
+    """
+    session_id = 'amzn1.echo-api.session.%s' % uuid.uuid4()
+    device_id = 'amzn1.ask.device.ECHO%d' % rng.randrange(8)
+    if ending is None:
+        ending = rng.choices([name for name, _ in DIALOG_ENDINGS],
+                             [weight for _, weight in DIALOG_ENDINGS])[0]
+    room_id, room = rng.choice(ROOMS)
+    slots = {'some_slot': (room.lower(), room_id, room)}
+    dialog = [
+        make_request(session_id, 'LaunchRequest', device_id=device_id),
+        make_request(session_id,
+                     'IntentRequest',
+                     'exampleIntent',
+                     'STARTED',
+                     device_id=device_id),
+        make_request(session_id,
+                     'IntentRequest',
+                     'exampleIntent',
+                     'IN_PROGRESS',
+                     slots=slots,
+                     device_id=device_id),
+    ]
+    completed = make_request(
+        session_id,
+        'IntentRequest',
+        'exampleIntent',
+        'COMPLETED',
+        slots=slots,
+        confirmation_status='DENIED' if ending == 'denied' else 'CONFIRMED',
+        device_id=device_id)
+    dialog.append(completed)
+    if ending == 'next':
+        dialog.append(
+            make_request(session_id,
+                         'IntentRequest',
+                         'yesIntent',
+                         'COMPLETED',
+                         device_id=device_id))
+        dialog.append(
+            make_request(session_id, 'SessionEndedRequest',
+                         device_id=device_id))
+    elif ending == 'stop':
+        dialog.append(
+            make_request(session_id,
+                         'IntentRequest',
+                         'AMAZON.StopIntent',
+                         'COMPLETED',
+                         device_id=device_id))
+    elif ending == 'unknown_intent':
+        dialog.append(
+            make_request(session_id,
+                         'IntentRequest',
+                         'noSuchIntent',
+                         'COMPLETED',
+                         device_id=device_id))
+    # 'abandoned' and 'denied' dialogs just stop here
+    return dialog
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+"""parser_bench.py -- Part of Alexa App for Appdaemon
+Copyright (C) 2021 foorensic
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+https://github.com/foorensic/appdaemon-alexa
+
+Microbenchmark of `helpers.parse_request` against the nested
+`.get(..., {})` parser it replaced, using the sample payloads in
+payloads.jsonl. Also compares the memory a parsed request keeps
+(traced with tracemalloc) as the old dicts and as records.
+
+    python benchmarks/parser_bench.py [--number N] [--copies N]
+
+"""
+import argparse
+import json
+import os
+import sys
+import timeit
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import helpers  # noqa: E402 pylint: disable=wrong-import-position
+
+PAYLOADS = os.path.join(os.path.dirname(__file__), 'payloads.jsonl')
+
+
+def legacy_parse(data, devices):
+    """The parser as it was in AlexaAPI.get_request_data_from_json"""
+    error = data.get('request', {}).get('error', {}).get('message', '')
+    device_id = data.get('context',
+                         {}).get('System',
+                                 {}).get('device',
+                                         {}).get('deviceId', '<no_device_id>')
+    device = devices.get(device_id, 'unknown device')
+    slots = {}
+    for slot_value in data.get('request', {}).get('intent',
+                                                  {}).get('slots',
+                                                          {}).values():
+        slots[slot_value.get('name')] = {
+            'value': slot_value.get('value'),
+            'resolutions': []
+        }
+        for resolution in slot_value.get('resolutions',
+                                         {}).get('resolutionsPerAuthority',
+                                                 []):
+            if resolution.get('status', {}).get('code',
+                                                '') != 'ER_SUCCESS_MATCH':
+                continue
+            for rpa_value in resolution.get('values', []):
+                slots[slot_value.get('name')]['resolutions'].append({
+                    'id':
+                    rpa_value.get('value', {}).get('id', ''),
+                    'name':
+                    rpa_value.get('value', {}).get('name', '')
+                })
+    intent = data.get('request', {}).get('intent', {}).get('name', '')
+    confirmation_status = data.get('request',
+                                   {}).get('intent',
+                                           {}).get('confirmationStatus',
+                                                   'NONE')
+    return {
+        'type': data.get('request', {}).get('type', ''),
+        'intent': intent,
+        'confirmation_status': confirmation_status,
+        'dialog_state': data.get('request', {}).get('dialogState', ''),
+        'device': device,
+        'slots': slots,
+        'error': error
+    }
+
+
+def legacy_records_parse(data, devices):
+    """`legacy_parse`, but building the records apps get today"""
+    request = legacy_parse(data, devices)
+    request['slots'] = {
+        name: helpers.Slot(
+            slot['value'],
+            tuple(
+                helpers.Resolution(resolution['id'], resolution['name'])
+                for resolution in slot['resolutions']))
+        for name, slot in request['slots'].items()
+    }
+    return helpers.Request(**request)
+
+
+def retained_bytes(parse, decoded, copies):
+    """Returns the bytes per request that `copies` rounds of parsing all
+    `decoded` payloads with `parse` keep allocated
+
+    """
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    kept = [parse(data) for _ in range(copies) for data in decoded]
+    retained = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return retained / len(kept)
+
+
+def load_payloads(path=PAYLOADS):
+    """Returns the raw lines of the payload file"""
+    with open(path, 'rb') as payload_file:
+        return [line.strip() for line in payload_file if line.strip()]
+
+
+def main():
+    """Runs the benchmark"""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[5])
+    parser.add_argument('--number', type=int, default=20000)
+    parser.add_argument('--copies', type=int, default=1000)
+    args = parser.parse_args()
+
+    raw = load_payloads()
+    decoded = [json.loads(line) for line in raw]
+    devices = {'amzn1.ask.device.KITCHENECHO': 'kitchen'}
+    device_name = lambda device_id: devices.get(device_id, 'unknown device')
+
+    # Both parsers have to agree before we compare their speed
+    for data in decoded:
+        assert helpers.parse_request(
+            data, device_name).to_dict() == legacy_parse(data, devices)
+
+    def run_legacy():
+        for data in decoded:
+            legacy_parse(data, devices)
+
+    def run_legacy_records():
+        for data in decoded:
+            legacy_records_parse(data, devices)
+
+    def run_schema():
+        for data in decoded:
+            helpers.parse_request(data, device_name)
+
+    def run_schema_resolved():
+        for data in decoded:
+            for slot in helpers.parse_request(data,
+                                              device_name).slots.values():
+                slot.resolutions  # pylint: disable=pointless-statement
+
+    def run_legacy_bytes():
+        for line in raw:
+            legacy_parse(json.loads(line), devices)
+
+    def run_schema_bytes():
+        for line in raw:
+            helpers.parse_request(line, device_name)
+
+    cases = [
+        ('legacy parser', run_legacy),
+        ('legacy parser, records', run_legacy_records),
+        ('schema parser', run_schema),
+        ('schema parser, resolutions read', run_schema_resolved),
+        ('json.loads + legacy parser', run_legacy_bytes),
+        ('raw bytes + schema parser (%s)' %
+         ('orjson' if helpers.orjson else 'json'), run_schema_bytes),
+    ]
+    print('%d payloads x %d runs' % (len(decoded), args.number))
+    for name, func in cases:
+        seconds = min(timeit.repeat(func, number=args.number, repeat=3))
+        print('%-40s %8.2f us/request' %
+              (name, seconds / args.number / len(decoded) * 1e6))
+
+    def parse_resolved(data):
+        request = helpers.parse_request(data, device_name)
+        for slot in request.slots.values():
+            slot.resolutions  # pylint: disable=pointless-statement
+        return request
+
+    # What a parsed request costs while it is kept in a session
+    print('%d payloads x %d copies kept' % (len(decoded), args.copies))
+    for name, parse in [
+        ('legacy parser (dicts)', lambda data: legacy_parse(data, devices)),
+        ('schema parser (records)',
+         lambda data: helpers.parse_request(data, device_name)),
+        ('schema parser, resolutions read', parse_resolved),
+    ]:
+        print('%-40s %8.0f bytes/request' %
+              (name, retained_bytes(parse, decoded, args.copies)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+"""replay.py -- Part of Alexa App for Appdaemon
+Copyright (C) 2021 foorensic
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+https://github.com/foorensic/appdaemon-alexa
+
+Replay benchmark: sends the recorded dialogs in payloads.jsonl and
+synthetic multi-turn dialogs through `AlexaAPI.api_call`, with
+`concurrency` dialogs in flight at a time, and reports throughput,
+latency percentiles, allocations per request and session growth.
+
+    python benchmarks/replay.py [--dialogs N] [--concurrency C]
+                                [--save-baseline FILE | --baseline FILE]
+
+With --baseline, the run fails if throughput dropped or p95 latency
+rose by more than --tolerance compared to the saved baseline.
+
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+from concurrent import futures
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import harness  # noqa: E402 pylint: disable=wrong-import-position
+
+
+def build_dialogs(count, seed):
+    """Returns `count` dialogs, the recorded ones and synthetic ones"""
+    rng = random.Random(seed)
+    recorded = harness.load_payloads()
+    dialogs = []
+    while len(dialogs) < count:
+        if len(dialogs) % 4 == 0:
+            dialogs.append(harness.renew_dialog(rng.choice(recorded)))
+        else:
+            dialogs.append(harness.synthetic_dialog(rng))
+    return dialogs
+
+
+def percentile(values, percent):
+    """Returns the `percent` percentile of sorted `values`"""
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, int(round(len(values) * percent / 100.0)))
+    return values[index]
+
+
+def run_dialogs(api, dialogs, concurrency):
+    """Replays `dialogs`, turns of one dialog in order. Returns the
+    latencies of all requests and the wall time
+
+    """
+    def run_dialog(dialog):
+        latencies = []
+        for data in dialog:
+            started = time.perf_counter()
+            _, code = api.api_call(data, {})
+            latencies.append(time.perf_counter() - started)
+            assert code == 200, 'Request failed with %s' % code
+        return latencies
+
+    started = time.perf_counter()
+    if concurrency <= 1:
+        results = [run_dialog(dialog) for dialog in dialogs]
+    else:
+        with futures.ThreadPoolExecutor(max_workers=concurrency) as pool:
+            results = list(pool.map(run_dialog, dialogs))
+    wall = time.perf_counter() - started
+    return sorted(latency for result in results for latency in result), wall
+
+
+def measure_allocations(api, dialogs):
+    """Replays `dialogs` under tracemalloc. Returns the average peak and
+    retained bytes per request
+
+    """
+    requests = sum(len(dialog) for dialog in dialogs)
+    tracemalloc.start()
+    try:
+        before, _ = tracemalloc.get_traced_memory()
+        peaks = 0
+        for dialog in dialogs:
+            for data in dialog:
+                tracemalloc.reset_peak()
+                current, _ = tracemalloc.get_traced_memory()
+                api.api_call(data, {})
+                peaks += tracemalloc.get_traced_memory()[1] - current
+        after, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peaks / requests, (after - before) / requests
+
+
+def run(args):
+    """Runs the benchmark and returns the results"""
+    api = harness.load_apps()
+    # Warm up caches and code paths before measuring
+    run_dialogs(api, build_dialogs(50, args.seed + 1), 1)
+    sessions_before = len(api.sessions)
+
+    dialogs = build_dialogs(args.dialogs, args.seed)
+    latencies, wall = run_dialogs(api, dialogs, args.concurrency)
+    sessions_after = len(api.sessions)
+    peak, retained = measure_allocations(
+        api, build_dialogs(min(args.dialogs, 500), args.seed + 2))
+
+    return {
+        'dialogs': len(dialogs),
+        'requests': len(latencies),
+        'concurrency': args.concurrency,
+        'throughput_rps': round(len(latencies) / wall, 1),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 4),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 4),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 4),
+        'max_ms': round(latencies[-1] * 1000, 4),
+        'alloc_peak_bytes_per_request': round(peak),
+        'retained_bytes_per_request': round(retained),
+        'session_growth': sessions_after - sessions_before,
+        'sessions': len(api.sessions),
+        'session_stats': api.sessions.get_stats(),
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Returns the regressions of `results` against `baseline`"""
+    regressions = []
+    for key in ['dialogs', 'concurrency']:
+        if results[key] != baseline[key]:
+            regressions.append('%s %s differs from baseline %s, runs are '
+                               'not comparable' %
+                               (key, results[key], baseline[key]))
+    if results['throughput_rps'] < baseline['throughput_rps'] * (1 -
+                                                                 tolerance):
+        regressions.append('throughput %s rps < baseline %s rps' %
+                           (results['throughput_rps'],
+                            baseline['throughput_rps']))
+    for key in ['p95_ms', 'alloc_peak_bytes_per_request']:
+        if results[key] > baseline[key] * (1 + tolerance):
+            regressions.append('%s %s > baseline %s' %
+                               (key, results[key], baseline[key]))
+    return regressions
+
+
+def main():
+    """Command line entry point"""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[5])
+    parser.add_argument('--dialogs', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--save-baseline', metavar='FILE')
+    parser.add_argument('--baseline', metavar='FILE')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+
+    results = run(args)
+    print(json.dumps(results, indent=2))
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as baseline_file:
+            json.dump(results, baseline_file, indent=2)
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare(results, json.load(baseline_file),
+                                  args.tolerance)
+        for regression in regressions:
+            print('REGRESSION: %s' % regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+"""resolver_bench.py -- Part of Alexa App for Appdaemon
+Copyright (C) 2021 foorensic
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+https://github.com/foorensic/appdaemon-alexa
+
+Benchmark of `resolver.EntityResolver`: indexes `--entities` generated
+Home Assistant entities and looks up spoken variants of their names,
+as Alexa transcribes them (exact, lower case, words run together,
+typos, sound-alikes), plus names that match nothing. Reports the hit
+rate (right entity first), the false matches, the lookup latency
+percentiles and the cost of building and updating the index.
+
+    python benchmarks/resolver_bench.py [--entities N] [--queries N]
+
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import resolver  # noqa: E402 pylint: disable=wrong-import-position
+
+FLOORS = ['', 'upstairs', 'downstairs', 'basement', 'attic', 'garden']
+ROOMS = [
+    'kitchen', 'living room', 'bedroom', 'office', 'bathroom', 'hallway',
+    'dining room', 'guest room', 'nursery', 'garage', 'laundry', 'porch',
+    'study', 'library', 'playroom', 'workshop', 'pantry', 'closet'
+]
+THINGS = [('light', 'ceiling light'), ('light', 'lamp'),
+          ('light', 'spotlights'), ('light', 'led strip'),
+          ('switch', 'fan'), ('switch', 'heater'), ('switch', 'coffee maker'),
+          ('media_player', 'speaker'), ('media_player', 'television'),
+          ('cover', 'blinds'), ('cover', 'shutter'), ('climate', 'thermostat'),
+          ('sensor', 'temperature'), ('sensor', 'humidity'),
+          ('binary_sensor', 'motion'), ('binary_sensor', 'window')]
+# How Alexa might transcribe a name
+SOUND_ALIKES = [('room', 'rum'), ('light', 'lite'), ('ceiling', 'sealing'),
+                ('kitchen', 'kitchin'), ('speaker', 'speeker'),
+                ('living', 'liveing'), ('office', 'offis'), ('fan', 'fann')]
+
+
+def make_states(count, rng):
+    """Returns `count` entities as `Hass.get_state()` would, with unique
+    friendly names
+
+    """
+    states = {}
+    names = set()
+    number = 0
+    while len(states) < count:
+        floor, room = rng.choice(FLOORS), rng.choice(ROOMS)
+        domain, thing = rng.choice(THINGS)
+        name = ' '.join(filter(None, [floor, room, thing])).title()
+        if name in names:
+            number += 1
+            name = '%s %d' % (name, number)
+        names.add(name)
+        entity_id = '%s.%s' % (domain, resolver.normalize_name(name).replace(
+            ' ', '_'))
+        states[entity_id] = {
+            'state': 'on',
+            'attributes': {
+                'friendly_name': name
+            }
+        }
+    return states
+
+
+def variant(name, rng):
+    """Returns a spoken variant of `name` and its kind"""
+    kind = rng.choice(['exact', 'lower', 'joined', 'typo', 'sound-alike'])
+    text = name.lower()
+    if kind == 'exact':
+        return name, kind
+    if kind == 'joined':
+        words = text.split()
+        if len(words) > 1:
+            index = rng.randrange(len(words) - 1)
+            words[index:index + 2] = [words[index] + words[index + 1]]
+        return ' '.join(words), kind
+    if kind == 'typo':
+        index = rng.randrange(1, len(text) - 1)
+        return text[:index] + text[index + 1:], kind
+    if kind == 'sound-alike':
+        for word, alike in rng.sample(SOUND_ALIKES, len(SOUND_ALIKES)):
+            if word in text:
+                return text.replace(word, alike, 1), kind
+    return text, 'lower'
+
+
+def percentile(values, percent):
+    """Returns the `percent` percentile of sorted `values`"""
+    return values[min(len(values) - 1, int(len(values) * percent / 100.0))]
+
+
+def main():  # pylint: disable=too-many-locals
+    """Runs the benchmark"""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[5])
+    parser.add_argument('--entities', type=int, default=5000)
+    parser.add_argument('--queries', type=int, default=5000)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    states = make_states(args.entities, rng)
+    entities = resolver.EntityResolver()
+    started = time.perf_counter()
+    entities.update_from_states(states)
+    build = time.perf_counter() - started
+
+    entity_ids = list(states)
+    queries = []
+    for _ in range(args.queries):
+        entity_id = rng.choice(entity_ids)
+        text, kind = variant(states[entity_id]['attributes']['friendly_name'],
+                             rng)
+        queries.append((text, kind, entity_id))
+    for number in range(args.queries // 10):
+        queries.append(('%s number %d' % (rng.choice(
+            ['pizza oven', 'aquarium pump', 'christmas tree', 'sprinkler']),
+                                          number), 'unknown', None))
+
+    kinds: dict = {}
+    latencies = []
+    for text, kind, expected in queries:
+        started = time.perf_counter()
+        match = entities.resolve(text)
+        latencies.append(time.perf_counter() - started)
+        hits, total = kinds.get(kind, (0, 0))
+        if expected is None:
+            hits += match is None
+        else:
+            hits += match is not None and match.id == expected
+        kinds[kind] = (hits, total + 1)
+    latencies.sort()
+
+    started = time.perf_counter()
+    for entity_id in entity_ids[:100]:
+        entities.add(entity_id, ['Renamed %s' % entity_id])
+    update = (time.perf_counter() - started) / 100
+
+    print('%d entities indexed in %.1f ms, %.1f us per update' %
+          (len(entities), build * 1000, update * 1e6))
+    for kind, (hits, total) in sorted(kinds.items()):
+        print('%-12s %5d queries %6.1f%% %s' %
+              (kind, total, hits * 100.0 / total,
+               'no match' if kind == 'unknown' else 'right entity first'))
+    print('lookup p50 %.3f ms, p95 %.3f ms, p99 %.3f ms, max %.3f ms' %
+          (percentile(latencies, 50) * 1000, percentile(latencies, 95) *
+           1000, percentile(latencies, 99) * 1000, latencies[-1] * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+"""resp_server.py -- Part of Alexa App for Appdaemon
+Copyright (C) 2021 foorensic
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+https://github.com/foorensic/appdaemon-alexa
+
+Local stand-in for a key-value server speaking the Redis protocol
+(RESP), with just the commands `sessions.RespSessionBackend` uses, so
+shared sessions can be tried without a Redis installation.
+
+    python benchmarks/resp_server.py [--port 6379]
+
+"""
+import argparse
+import socket
+import socketserver
+import threading
+import time
+
+
+class Store:
+    """Lists with expiry times, as the server keeps them"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.lists = {}
+        self.expires = {}
+        self.commands = 0
+
+    def _live(self, key):
+        """Returns the list of `key`, dropping it if it expired"""
+        expires = self.expires.get(key)
+        if expires is not None and expires <= time.monotonic():
+            self.lists.pop(key, None)
+            del self.expires[key]
+        return self.lists.get(key)
+
+    @staticmethod
+    def _range(values, start, stop):
+        """Slices `values` like LRANGE does with inclusive, negative
+        indexes
+
+        """
+        length = len(values)
+        start = max(start + length if start < 0 else start, 0)
+        stop = stop + length if stop < 0 else stop
+        return start, min(stop, length - 1) + 1
+
+    def execute(self, command, args):  # pylint: disable=too-many-return-statements
+        """Runs one command, returns its reply"""
+        with self.lock:
+            self.commands += 1
+            if command == b'PING':
+                return 'PONG'
+            key = args[0]
+            values = self._live(key)
+            if command == b'RPUSH':
+                values = self.lists.setdefault(key, [])
+                values.extend(args[1:])
+                return len(values)
+            if command == b'LRANGE':
+                if values is None:
+                    return []
+                start, stop = self._range(values, int(args[1]), int(args[2]))
+                return values[start:stop]
+            if command == b'LTRIM':
+                if values is not None:
+                    start, stop = self._range(values, int(args[1]),
+                                              int(args[2]))
+                    values[:] = values[start:stop]
+                    if not values:
+                        del self.lists[key]
+                        self.expires.pop(key, None)
+                return 'OK'
+            if command == b'PEXPIRE':
+                if values is None:
+                    return 0
+                self.expires[key] = time.monotonic() + int(args[1]) / 1000.0
+                return 1
+            if command == b'PTTL':
+                if values is None:
+                    return -2
+                if key not in self.expires:
+                    return -1
+                return int((self.expires[key] - time.monotonic()) * 1000)
+            if command == b'DEL':
+                self.expires.pop(key, None)
+                return 1 if self.lists.pop(key, None) is not None else 0
+            return Exception('ERR unknown command %r' % command)
+
+
+def encode(reply):
+    """Encodes `reply` as RESP"""
+    if isinstance(reply, Exception):
+        return b'-%s\r\n' % str(reply).encode()
+    if isinstance(reply, str):
+        return b'+%s\r\n' % reply.encode()
+    if isinstance(reply, int):
+        return b':%d\r\n' % reply
+    if reply is None:
+        return b'$-1\r\n'
+    if isinstance(reply, list):
+        return b'*%d\r\n' % len(reply) + b''.join(encode(item)
+                                                    for item in reply)
+    return b'$%d\r\n%s\r\n' % (len(reply), reply)
+
+
+class RespHandler(socketserver.StreamRequestHandler):
+    """Serves the commands of one connection"""
+    def setup(self):
+        super().setup()
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def handle(self):
+        while True:
+            line = self.rfile.readline()
+            if not line.startswith(b'*'):
+                return
+            args = []
+            for _ in range(int(line[1:])):
+                length = int(self.rfile.readline()[1:])
+                args.append(self.rfile.read(length + 2)[:-2])
+            reply = self.server.store.execute(args[0].upper(), args[1:])
+            self.wfile.write(encode(reply))
+
+
+class RespServer(socketserver.ThreadingTCPServer):
+    """Threaded stand-in server, `port` 0 picks a free port"""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host='127.0.0.1', port=0):
+        super().__init__((host, port), RespHandler)
+        self.store = Store()
+
+    @property
+    def address(self):
+        """'host:port' the server listens on"""
+        return '%s:%d' % self.server_address
+
+    def start(self):
+        """Serves from a background thread"""
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return self
+
+
+def main():
+    """Command line entry point"""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[5])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=6379)
+    args = parser.parse_args()
+    server = RespServer(args.host, args.port)
+    print('Listening on %s' % server.address)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+"""shared_sessions.py -- Part of Alexa App for Appdaemon
+Copyright (C) 2021 foorensic
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+https://github.com/foorensic/appdaemon-alexa
+
+Runs several `AlexaAPI` instances sharing their sessions on the
+stand-in server of resp_server.py (or `--server host:port`). Turns of
+the synthetic dialogs go to the instances round robin, the worst case
+for a load balancer without affinity, or with `--affinity` to the
+instance `sessions.ConsistentHashRing` picks for the session. Fails if
+an instance does not see all earlier turns of a session, and reports
+the throughput and the round trips to the server per turn.
+
+    python benchmarks/shared_sessions.py [--instances N] [--dialogs N]
+                                         [--affinity] [--server HOST:PORT]
+
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import harness  # noqa: E402 pylint: disable=wrong-import-position
+import resp_server  # noqa: E402 pylint: disable=wrong-import-position
+
+
+def run(args):
+    """Runs the dialogs, returns (turns, seconds, round trips, problems)"""
+    server = None
+    address = args.server
+    if address is None:
+        server = resp_server.RespServer().start()
+        address = server.address
+    instances = {
+        'alexa-%d' % number:
+        harness.load_apps(alexa_args={'sessionServer': address})
+        for number in range(args.instances)
+    }
+    import sessions  # pylint: disable=import-outside-toplevel
+    ring = sessions.ConsistentHashRing(instances)
+    names = sorted(instances)
+
+    rng = random.Random(args.seed)
+    dialogs = [harness.synthetic_dialog(rng) for _ in range(args.dialogs)]
+    problems = []
+    turns = 0
+    started = time.perf_counter()
+    for dialog in dialogs:
+        for number, data in enumerate(dialog):
+            session_id = data['session']['sessionId']
+            if args.affinity:
+                name = ring.get(session_id)
+            else:
+                name = names[turns % len(names)]
+            api = instances[name]
+            _, code = api.api_call(data, {})
+            turns += 1
+            if code != 200:
+                problems.append('%s: turn %d failed with %s' %
+                                (session_id, number, code))
+            session = api.sessions.get(session_id)
+            if session is not None and len(session['requests']) != number + 1:
+                problems.append('%s: %s saw %d turns instead of %d' %
+                                (session_id, name, len(
+                                    session['requests']), number + 1))
+    seconds = time.perf_counter() - started
+    round_trips = sum(api.sessions.backend.client.round_trips
+                      for api in instances.values())
+    for api in instances.values():
+        api.terminate()
+    if server is not None:
+        server.shutdown()
+        server.server_close()
+    return turns, seconds, round_trips, problems
+
+
+def main():
+    """Command line entry point"""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[5])
+    parser.add_argument('--instances', type=int, default=2)
+    parser.add_argument('--dialogs', type=int, default=500)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--affinity', action='store_true')
+    parser.add_argument('--server', metavar='HOST:PORT')
+    args = parser.parse_args()
+
+    turns, seconds, round_trips, problems = run(args)
+    print('%d instances, %d turns: %.1f turns/s, %.2f round trips/turn %s' %
+          (args.instances, turns, turns / seconds, round_trips / turns,
+           'FAILED' if problems else 'ok'))
+    for problem in problems[:10]:
+        print('    %s' % problem)
+    if problems:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
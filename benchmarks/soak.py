@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+"""soak.py -- Part of Alexa App for Appdaemon
+Copyright (C) 2021 foorensic
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+https://github.com/foorensic/appdaemon-alexa
+
+Soak test: drives synthetic dialogs through `AlexaAPI.api_call` on the
+stand-in Hass of harness.py, with abandoned sessions, Stop, denied
+confirmations, unknown and made up intents, failing intent apps,
+CanFulfillIntentRequests, an app reading `--entities` states through
+`request.states` and malformed requests mixed in. Every `--interval`
+dialogs it samples the traced memory, the number of live objects and
+the sizes of the app's stores. After `--warmup` dialogs, once the
+bounded stores are full, memory has to stay flat: the run fails if
+traced memory grew by more than `--max-growth-kb` or the number of
+objects by more than `--max-object-growth` since then. It also fails
+if the dispatch table or the metrics grew since then, or turns kept in
+sessions still hold their state snapshot.
+
+    python benchmarks/soak.py [--dialogs N] [--warmup N] [--interval N]
+                              [--entities N]
+                              [--max-growth-kb KB]
+                              [--max-object-growth N] [--no-tracemalloc]
+
+"""
+import argparse
+import gc
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import harness  # noqa: E402 pylint: disable=wrong-import-position
+
+
+class FailingIntent:
+    """Intent app that fails, for the error paths"""
+    def intentCompleted(self, request):  # pylint: disable=invalid-name,no-self-use
+        """Raises like a broken app would"""
+        raise RuntimeError('Failing on purpose for %s' % request.intent)
+
+
+class StatesIntent:
+    """Intent app reading Home Assistant states through `request.states`"""
+    def intentCompleted(self, request):  # pylint: disable=invalid-name,no-self-use
+        """Reads an entity and a whole domain"""
+        lights = request.states.get_state('light')
+        state = request.states.get_state('light.lamp_0')
+        return 'The lamp is %s, %d lights' % (state, len(lights))
+
+
+def make_states(count):
+    """Returns `count` light states for the stand-in Hass"""
+    return {
+        'light.lamp_%d' % number: {
+            'state': 'on' if number % 2 else 'off',
+            'attributes': {
+                'friendly_name': 'Lamp %d' % number
+            }
+        }
+        for number in range(count)
+    }
+
+
+def soak_dialog(rng):
+    """Returns a dialog: mostly the synthetic ones of the harness, some
+    hitting a failing app, asking CanFulfill or malformed
+
+    """
+    kind = rng.random()
+    if kind < 0.05:
+        return [{'malformed': True}]
+    dialog = harness.synthetic_dialog(rng)
+    session_id = dialog[0]['session']['sessionId']
+    if kind < 0.15:
+        dialog.insert(
+            1,
+            harness.make_request(session_id, 'IntentRequest',
+                                 'failingIntent', 'COMPLETED'))
+    elif kind < 0.25:
+        dialog.insert(
+            0,
+            harness.make_request(session_id, 'CanFulfillIntentRequest',
+                                 'exampleIntent'))
+    elif kind < 0.35:
+        dialog.insert(
+            1,
+            harness.make_request(session_id, 'IntentRequest', 'statesIntent',
+                                 'COMPLETED'))
+    elif kind < 0.45:
+        # Intent names come from the requests, there is no end to them
+        dialog.insert(
+            1,
+            harness.make_request(session_id, 'IntentRequest',
+                                 'madeUpIntent%d' % rng.getrandbits(32),
+                                 'COMPLETED'))
+    return dialog
+
+
+def sample(api, tracing):
+    """Returns the traced memory, the live objects and the store sizes"""
+    gc.collect()
+    return {
+        'traced_kb': (tracemalloc.get_traced_memory()[0] /
+                      1024.0 if tracing else 0.0),
+        'objects': len(gc.get_objects()),
+        'sessions': len(api.sessions),
+        'turns': sum(
+            len(api.sessions[session_id]['requests'])
+            for session_id in list(api.sessions._sessions)),  # pylint: disable=protected-access
+        'snapshots': sum(
+            turn.states is not None
+            for session_id in list(api.sessions._sessions)  # pylint: disable=protected-access
+            for turn in api.sessions[session_id]['requests']),
+        'responses':
+        len(api.responses) if api.responses is not None else 0,
+        'can_fulfill': api.can_fulfill_cache.get_stats().get('entries', 0),
+        'dispatch': len(api.dispatch),
+        'metrics': len(api.metrics.snapshot()),
+    }
+
+
+def run(args):
+    """Runs the soak test, returns the samples and the problems"""
+    api = harness.load_apps(alexa_args={
+        'maxSessions': args.max_sessions,
+        'canFulfillCache': 30,
+        'intents': ['exampleIntent'],
+    }, states=make_states(args.entities))
+    api.apps['failingIntent'] = FailingIntent()
+    api.apps['statesIntent'] = StatesIntent()
+    rng = random.Random(args.seed)
+    tracing = not args.no_tracemalloc
+    if tracing:
+        tracemalloc.start()
+
+    samples = []
+    baseline = None
+    requests = 0
+    started = time.perf_counter()
+    print('%9s %9s %10s %9s %8s %7s %9s' %
+          ('dialogs', 'requests', 'traced_kb', 'objects', 'sessions',
+           'turns', 'responses'))
+    for number in range(1, args.dialogs + 1):
+        for data in soak_dialog(rng):
+            api.api_call(data, {})
+            requests += 1
+        if number % args.interval and number != args.dialogs:
+            continue
+        entry = dict(sample(api, tracing), dialogs=number, requests=requests)
+        samples.append(entry)
+        print('%9d %9d %10.1f %9d %8d %7d %9d' %
+              (number, requests, entry['traced_kb'], entry['objects'],
+               entry['sessions'], entry['turns'], entry['responses']))
+        if baseline is None and number >= args.warmup:
+            baseline = entry
+    seconds = time.perf_counter() - started
+    if tracing:
+        tracemalloc.stop()
+
+    problems = []
+    last = samples[-1]
+    if baseline is None or baseline is last:
+        problems.append('no samples after the warmup, run more dialogs')
+        return samples, problems, seconds
+    growth = last['traced_kb'] - baseline['traced_kb']
+    if growth > args.max_growth_kb:
+        problems.append('traced memory grew by %.1f KB (limit %d KB)' %
+                        (growth, args.max_growth_kb))
+    objects = last['objects'] - baseline['objects']
+    if objects > args.max_object_growth:
+        problems.append('%d more live objects (limit %d)' %
+                        (objects, args.max_object_growth))
+    for store in ['dispatch', 'metrics']:
+        if last[store] > baseline[store]:
+            problems.append('%s grew from %d to %d entries' %
+                            (store, baseline[store], last[store]))
+    if last['snapshots']:
+        problems.append('%d stored turns keep their state snapshot' %
+                        last['snapshots'])
+    if last['sessions'] > args.max_sessions:
+        problems.append('%d sessions kept (limit %d)' %
+                        (last['sessions'], args.max_sessions))
+    return samples, problems, seconds
+
+
+def main():
+    """Command line entry point"""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[5])
+    parser.add_argument('--dialogs', type=int, default=100000)
+    parser.add_argument('--warmup', type=int, default=10000)
+    parser.add_argument('--interval', type=int, default=10000)
+    parser.add_argument('--max-sessions', type=int, default=1000)
+    parser.add_argument('--entities', type=int, default=200)
+    parser.add_argument('--max-growth-kb', type=int, default=256)
+    parser.add_argument('--max-object-growth', type=int, default=2000)
+    parser.add_argument('--no-tracemalloc', action='store_true')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    samples, problems, seconds = run(args)
+    print('%d requests in %.1f s %s' %
+          (samples[-1]['requests'], seconds, 'FAILED' if problems else 'ok'))
+    for problem in problems:
+        print('    %s' % problem)
+    if problems:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+"""speech_check.py -- Part of Alexa App for Appdaemon
+Copyright (C) 2021 foorensic
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+https://github.com/foorensic/appdaemon-alexa
+
+Differential check of the speech templates (`helpers.compile_speech`)
+against the replace-based `AlexaAPI.prepare_speech` they replaced:
+renders the fixed edge cases and `--cases` random texts, slots and
+device names, built from braces, dots, underscores, placeholders of
+missing slots and a slot named 'device', with both and fails on the
+first difference.
+
+    python benchmarks/speech_check.py [--cases N] [--seed N]
+
+"""
+import argparse
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import helpers  # noqa: E402 pylint: disable=wrong-import-position
+
+# Building blocks of the random texts, slot values and device names
+PIECES = [
+    'a', 'b c', ' ', '_', '.', '..', '...', '{', '}', '{{', '}}', '{}', '{{}}',
+    '{{room}}', '{{device}}', '{{missing}}', '{{x_y}}', '{{room}', '{room}}',
+    "<break time='1s'/>"
+]
+SLOT_NAMES = ['room', 'device', 'x_y', 'other']
+
+# (text, slots as name -> value, device name)
+EDGE_CASES = [
+    ('', {}, 'tv'),
+    ('no placeholders', {}, 'tv'),
+    ('{{room}}', {'room': None}, 'tv'),
+    ('{{room}}', {'room': ''}, 'tv'),
+    ('Light in {{room}} is on', {'room': 'living_room'}, 'tv'),
+    ('Wait...{{room}}', {'room': '.'}, 'tv'),
+    ('Wait.{{room}}.', {'room': '.'}, 'tv'),
+    ('a.{{room}}', {'room': ''}, 'tv'),
+    ('a.{{room}}..', {'room': ''}, 'tv'),
+    ('Wait..{{room}}.', {'room': None}, 'tv'),
+    ('{{room}}..', {'room': 'x.'}, 'tv'),
+    ('{{{room}}}', {'room': 'x'}, 'tv'),
+    ('{{{{room}}}}', {'room': 'room'}, 'tv'),
+    ('{{room}}}}', {'room': '{{'}, 'tv'),
+    ('{{room}} {{other}}', {'room': '{{other}}', 'other': 'x'}, 'tv'),
+    ('{{other}} {{room}}', {'room': '{{other}}', 'other': 'x'}, 'tv'),
+    ('On {{device}}', {}, 'kitchen_echo...'),
+    ('On {{device}}', {'device': 'slot wins'}, 'tv'),
+    ('On {{device}}', {'device': None}, 'tv'),
+    ('On {{device}} in {{room}}', {'room': '{{device}}'}, 'tv'),
+    ('{{x_y}} and {{missing}}', {'x_y': 'a_b'}, 'tv'),
+    ('{{missing}}...', {}, 'tv'),
+    ('{{room}}{{room}}', {'room': '.'}, 'tv'),
+]
+
+
+def legacy_prepare_speech(text, slots, device):
+    """The replace-based `AlexaAPI.prepare_speech`, on slots as they
+    were: name -> {'value': ...}
+
+    """
+    if not text:
+        return text
+    for slotname, slotvalue in slots.items():
+        text = text.replace("{{" + slotname + "}}",
+                            slotvalue.get('value', '') or '')
+    return text.replace("{{device}}",
+                        device).replace("_", " ").replace(
+                            "...", "<break time='2s'/>")
+
+
+def template_speech(text, slots, device):
+    """The template renderer, as `AlexaAPI.prepare_speech` calls it"""
+    if not text:
+        return text
+    return helpers.compile_speech(text).render(
+        {
+            name: helpers.Slot(value, ())
+            for name, value in slots.items()
+        }, device)
+
+
+def random_text(rng, max_pieces):
+    """Returns a random concatenation of `PIECES`"""
+    return ''.join(
+        rng.choice(PIECES) for _ in range(rng.randint(0, max_pieces)))
+
+
+def random_case(rng):
+    """Returns a random (text, slots, device name)"""
+    slots = {}
+    for name in rng.sample(SLOT_NAMES, rng.randint(0, len(SLOT_NAMES))):
+        slots[name] = rng.choice([None, '', random_text(rng, 3)])
+    return random_text(rng, 8), slots, random_text(rng, 2) or 'tv'
+
+
+def check(text, slots, device):
+    """Returns None if both renderers agree, otherwise the difference"""
+    legacy_slots = {name: {'value': value} for name, value in slots.items()}
+    expected = legacy_prepare_speech(text, legacy_slots, device)
+    rendered = template_speech(text, slots, device)
+    if rendered == expected:
+        return None
+    return ('text %r, slots %r, device %r: expected %r, rendered %r' %
+            (text, slots, device, expected, rendered))
+
+
+def main():
+    """Command line entry point"""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[5])
+    parser.add_argument('--cases', type=int, default=200000)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    cases = EDGE_CASES + [random_case(rng) for _ in range(args.cases)]
+    for case in cases:
+        problem = check(*case)
+        if problem is not None:
+            print('%d cases FAILED' % len(cases))
+            print('    %s' % problem)
+            sys.exit(1)
+    print('%d cases ok' % len(cases))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+"""stress.py -- Part of Alexa App for Appdaemon
+Copyright (C) 2021 foorensic
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+https://github.com/foorensic/appdaemon-alexa
+
+Concurrency stress test: sends the turns of many sessions from a pool
+of threads, with turns of the same session racing each other, to an
+intent app that takes `--app-ms` per call (like a Home Assistant
+service call would). Fails if a turn is lost or two turns of one
+session were handled at the same time, and reports the throughput for
+each thread count.
+
+    python benchmarks/stress.py [--threads 1,2,4,8] [--sessions N]
+                                [--turns N] [--burst N] [--app-ms MS]
+
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+from concurrent import futures
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import harness  # noqa: E402 pylint: disable=wrong-import-position
+
+
+class StressIntent:
+    """Intent app recording the turns it sees per session"""
+    def __init__(self, app_seconds):
+        self.app_seconds = app_seconds
+        self.lock = threading.Lock()
+        self.active = set()
+        self.seen = {}
+        self.overlaps = 0
+
+    def intentCompleted(self, request):  # pylint: disable=invalid-name
+        """Records the turn number in slot 'turn' of session in 'session'"""
+        session = request.slots['session'].value
+        with self.lock:
+            if session in self.active:
+                self.overlaps += 1
+            self.active.add(session)
+        time.sleep(self.app_seconds)
+        with self.lock:
+            self.active.discard(session)
+            self.seen.setdefault(session, []).append(
+                int(request.slots['turn'].value))
+        return 'ok', {'shouldEndSession': False}
+
+
+def run(threads, sessions, turns, burst, app_seconds):
+    """Sends `turns` turns for each of `sessions` sessions from `threads`
+    threads, `burst` turns of a session at a time. Returns (requests per second, list of problems)
+
+    """
+    api = harness.load_apps(alexa_args={
+        'maxSessions': sessions * 2,
+        'maxSessionRequests': turns
+    })
+    app = StressIntent(app_seconds)
+    api.apps['stressIntent'] = app
+    work = []
+    # Sessions take turns sending `burst` turns at once, which race
+    # each other
+    for first in range(0, turns, burst):
+        for session in range(sessions):
+            session_id = 'session-%d' % session
+            for turn in range(first, min(first + burst, turns)):
+                work.append(
+                    harness.make_request(session_id,
+                                         'IntentRequest',
+                                         'stressIntent',
+                                         'COMPLETED',
+                                         slots={
+                                             'session':
+                                             (session_id, None, None),
+                                             'turn': (str(turn), None, None)
+                                         }))
+
+    started = time.perf_counter()
+    with futures.ThreadPoolExecutor(max_workers=threads) as pool:
+        for _, code in pool.map(lambda data: api.api_call(data, {}), work):
+            assert code == 200
+    wall = time.perf_counter() - started
+
+    problems = []
+    if app.overlaps:
+        problems.append('%d turns overlapped with another turn of their '
+                        'session' % app.overlaps)
+    for session in range(sessions):
+        session_id = 'session-%d' % session
+        seen = sorted(app.seen.get(session_id, []))
+        if seen != list(range(turns)):
+            problems.append('%s: app saw turns %s' % (session_id, seen))
+        recorded = len(api.sessions[session_id]['requests'])
+        if recorded != turns:
+            problems.append('%s: %d of %d turns recorded' %
+                            (session_id, recorded, turns))
+    return len(work) / wall, problems
+
+
+def main():
+    """Command line entry point"""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[5])
+    parser.add_argument('--threads', default='1,2,4,8')
+    parser.add_argument('--sessions', type=int, default=50)
+    parser.add_argument('--turns', type=int, default=10)
+    parser.add_argument('--burst', type=int, default=2)
+    parser.add_argument('--app-ms', type=float, default=2)
+    args = parser.parse_args()
+
+    failed = False
+    for threads in [int(count) for count in args.threads.split(',')]:
+        throughput, problems = run(threads, args.sessions, args.turns,
+                                   args.burst, args.app_ms / 1000)
+        print('%3d threads: %8.1f requests/s %s' %
+              (threads, throughput, 'FAILED' if problems else 'ok'))
+        for problem in problems[:10]:
+            print('    %s' % problem)
+        failed = failed or bool(problems)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+"""caches.py -- Part of Alexa App for Appdaemon
+Copyright (C) 2021 foorensic
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+https://github.com/foorensic/appdaemon-alexa
+
+Caches for responses: CanFulfillIntentRequest answers and answers to retried requests
+
+"""
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """Size bounded LRU cache whose entries expire after their `ttl`"""
+    def __init__(self, max_entries: int = 1000, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.clock = clock
+        self.lock = threading.Lock()
+        # key -> (expires, value), least recently used first
+        self._entries: OrderedDict = OrderedDict()
+        self.stats = {'hits': 0, 'misses': 0}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        """Returns the cached value for `key`, or `default`"""
+        with self.lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > self.clock():
+                    self._entries.move_to_end(key)
+                    self.stats['hits'] += 1
+                    return entry[1]
+                del self._entries[key]
+            self.stats['misses'] += 1
+            return default
+
+    def set(self, key, value, ttl):
+        """Caches `value` for `key` for `ttl` seconds"""
+        with self.lock:
+            self._entries.pop(key, None)
+            while len(self._entries) >= self.max_entries:
+                self._entries.popitem(last=False)
+            self._entries[key] = (self.clock() + ttl, value)
+
+    def get_stats(self):
+        """Returns the hit/miss stats along with the number of entries"""
+        return dict(self.stats, entries=len(self._entries))
+
+
+def can_fulfill_key(request):
+    """Cache key for the answer to a CanFulfillIntentRequest: the intent
+    with the normalized slot values and their resolution ids
+
+    """
+    return (request.intent,
+            tuple(
+                sorted((name, (slot.value or '').strip().lower(),
+                        tuple(resolution.id
+                              for resolution in slot.resolutions))
+                       for name, slot in request.slots.items())))
+
+
+class _PendingResponse:
+    """A response in the `ResponseCache`, possibly still being computed"""
+    __slots__ = ('response', 'done', 'expires')
+
+    def __init__(self, expires):
+        self.response = None
+        self.done = threading.Event()
+        self.expires = expires
+
+
+class ResponseCache:
+    """Short-lived cache of responses by Alexa request id
+
+    Alexa retries requests it did not get a timely answer for. With
+    this cache a retry gets the response of the first attempt, or
+    waits for it if the first attempt is still being handled, instead
+    of running the request (and the intent app) once more.
+
+    """
+    def __init__(self,
+                 ttl: float = 30,
+                 max_entries: int = 1000,
+                 wait_timeout: float = 6,
+                 clock=time.monotonic):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.wait_timeout = wait_timeout
+        self.clock = clock
+        self.lock = threading.Lock()
+        # Ordered by creation, oldest first
+        self._entries: OrderedDict = OrderedDict()
+        self.stats = {'hits': 0, 'misses': 0, 'waits': 0, 'wait_timeouts': 0}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get_or_run(self, request_id, func):
+        """Returns the response for `request_id`, calling `func()` to
+        create it if there is none yet. Returns None if another thread
+        is creating it and did not finish within `wait_timeout`
+
+        """
+        now = self.clock()
+        with self.lock:
+            while self._entries:
+                oldest = next(iter(self._entries.values()))
+                if oldest.expires > now and len(
+                        self._entries) < self.max_entries:
+                    break
+                self._entries.popitem(last=False)
+            entry = self._entries.get(request_id)
+            if entry is None:
+                entry = self._entries[request_id] = _PendingResponse(
+                    now + self.ttl)
+                self.stats['misses'] += 1
+                owner = True
+            else:
+                self.stats['hits'] += 1
+                owner = False
+                if not entry.done.is_set():
+                    self.stats['waits'] += 1
+
+        if not owner:
+            if not entry.done.wait(self.wait_timeout):
+                self.stats['wait_timeouts'] += 1
+            return entry.response
+
+        try:
+            entry.response = func()
+        except BaseException:
+            # Nothing to share, the next attempt runs again
+            with self.lock:
+                if self._entries.get(request_id) is entry:
+                    del self._entries[request_id]
+            raise
+        finally:
+            entry.done.set()
+        return entry.response
+
+    def get_stats(self):
+        """Returns the hit/miss stats along with the number of entries"""
+        return dict(self.stats, entries=len(self._entries))
+
+
+# Upper bounds (in seconds) of the `LatencyHistogram` buckets: 0.1ms
+# growing by 50% up to about a minute, anything above is the last bucket
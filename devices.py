@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+"""devices.py -- Part of Alexa App for Appdaemon
+Copyright (C) 2021 foorensic
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+https://github.com/foorensic/appdaemon-alexa
+
+Alexa device ids and their configured names
+
+"""
+import sys
+import threading
+
+import helpers
+
+
+def device_id(data):
+    """Returns the device id of the Alexa request `data` (decoded JSON)"""
+    device = ((data.get('context') or helpers.EMPTY).get('System')
+              or helpers.EMPTY).get('device') or helpers.EMPTY
+    return device.get('deviceId', '<no_device_id>')
+
+
+class DeviceRegistry:
+    """Resolves Alexa device ids to the names configured in `devices`
+
+    Device ids and names are interned and each device has one entry
+    [name, requests], so resolving a device is a single dict lookup and
+    counting its request an increment under the lock. Unknown devices get `unknown_name`, are
+    reported once to `on_unknown` (i.e. to log them) and at most
+    `max_unknown` of them are counted.
+
+    """
+    def __init__(self,
+                 devices=None,
+                 unknown_name='unknown device',
+                 on_unknown=None,
+                 max_unknown: int = 1000):
+        self.unknown_name = sys.intern(unknown_name)
+        self.on_unknown = on_unknown
+        self.max_unknown = max_unknown
+        self.lock = threading.Lock()
+        self._entries: dict = {}
+        self._unknown = 0
+        self.update(devices or {})
+
+    def update(self, devices):
+        """Replaces the configured devices, keeping the request counts"""
+        with self.lock:
+            entries = {}
+            for device_id, name in devices.items():
+                entry = self._entries.get(device_id, [None, 0])
+                entry[0] = sys.intern(str(name))
+                entries[sys.intern(str(device_id))] = entry
+            self._unknown = 0
+            for device_id, entry in self._entries.items():
+                if device_id not in entries:
+                    entries[device_id] = [self.unknown_name, entry[1]]
+                    self._unknown += 1
+            self._entries = entries
+
+    def name(self, device_id):
+        """Returns the name of `device_id` and counts its request"""
+        entry = self._entries.get(device_id)
+        if entry is None:
+            entry = self._add_unknown(device_id)
+        # Requests of one device can be handled in parallel
+        with self.lock:
+            entry[1] += 1
+        return entry[0]
+
+    def _add_unknown(self, device_id):
+        """Registers the unknown `device_id`, reporting it once"""
+        with self.lock:
+            entry = self._entries.get(device_id)
+            if entry is not None:
+                return entry
+            entry = [self.unknown_name, 0]
+            if self._unknown >= self.max_unknown:
+                return entry
+            self._entries[sys.intern(device_id)] = entry
+            self._unknown += 1
+        if self.on_unknown is not None:
+            self.on_unknown(device_id)
+        return entry
+
+    def get_stats(self):
+        """Returns the request counts per device id and the number of
+        known and unknown devices
+
+        """
+        with self.lock:
+            return {
+                'known': len(self._entries) - self._unknown,
+                'unknown': self._unknown,
+                'requests': {
+                    device_id: {
+                        'name': name,
+                        'requests': requests
+                    }
+                    for device_id, (name, requests) in self._entries.items()
+                }
+            }
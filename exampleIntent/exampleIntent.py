@@ -44,6 +44,14 @@ class exampleIntent(hass.Hass):
         resolutions = request.get('slots', {}).get('some_slot',
                                                    {}).get('resolutions', [])
 
+        # Alexa could not resolve the slot, so try to match what was
+        # said to one of our entities instead
+        if not resolutions and request.entities is not None:
+            match = request.entities.resolve(
+                request.get('slots', {}).get('some_slot', {}).get('value'))
+            if match is not None:
+                resolutions = [match]
+
         # Just in case we don't have a resolution. Should usually not
         # happen. Depends on your slot config
         if not resolutions:
@@ -51,7 +59,7 @@ class exampleIntent(hass.Hass):
 
         slot_value = resolutions[0].get('name')
         self.log('About to do something with "%s" and "%s"' %
-                 (self.tv_entity, slot_value))
+                 (self.device_entity, slot_value))
         # TODO: do something useful
 
         return helpers.random_pick([
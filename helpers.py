@@ -18,7 +18,18 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 https://github.com/foorensic/appdaemon-alexa
 
 """
+import json
 import random
+import re
+import time
+from collections.abc import Mapping
+from functools import lru_cache
+from types import MappingProxyType
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 
 def random_pick(entries):
@@ -28,3 +39,463 @@ def random_pick(entries):
     if isinstance(entries, list):
         return random.choice(entries)
     return entries
+
+
+# Shared empty mapping for lookups into missing parts of the JSON
+EMPTY: Mapping = MappingProxyType({})
+
+
+def json_loads(raw):
+    """Decodes JSON, using orjson if it is installed"""
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+
+SPEECH_PLACEHOLDER = re.compile(r'\{\{([^{}]*)\}\}')
+SPEECH_BREAK = "<break time='2s'/>"
+
+
+def clean_speech(text):
+    """Replaces '_' with spaces and '...' with a pause"""
+    return text.replace('_', ' ').replace('...', SPEECH_BREAK)
+
+
+class SpeechTemplate:
+    """A speech text parsed into literal and placeholder segments
+
+    Placeholders are `{{slotname}}` and `{{device}}`. The literals are
+    cleaned (see `clean_speech`) once when the template is compiled,
+    rendering then only has to clean and join the substituted values.
+
+    """
+    __slots__ = ('text', 'literals', 'names', 'unknown', 'fragile',
+                 'dotted')
+
+    def __init__(self, text):
+        self.text = text
+        parts = SPEECH_PLACEHOLDER.split(text)
+        literals = parts[::2]
+        self.names = tuple(parts[1::2])
+        self.literals = tuple(clean_speech(literal) for literal in literals)
+        # What we say for placeholders we have no value for
+        self.unknown = tuple(
+            clean_speech('{{' + name + '}}') for name in self.names)
+        # Values can merge with the surrounding literals, i.e. 'a.' +
+        # '..' gives a pause in the plain replace approach. Remember
+        # where that can happen, so `render` can fall back to it
+        edges = [(literals[i][-1:], literals[i + 1][:1])
+                 for i in range(len(self.names))]
+        self.dotted = any('.' in edge for edge in edges)
+        self.fragile = any(left == '{' or right == '}'
+                           for left, right in edges)
+
+    def render(self, slots, device):
+        """Returns the cleaned speech text with placeholders replaced by
+        the values of `slots` (name -> `Slot`) and the `device` name
+
+        """
+        if not self.names:
+            return self.literals[0]
+        if self.fragile:
+            return render_speech_plain(self.text, slots, device)
+        literals = self.literals
+        parts = [literals[0]]
+        for index, name in enumerate(self.names):
+            slot = slots.get(name)
+            if slot is not None:
+                value = slot.value or ''
+            elif name == 'device':
+                value = device
+            else:
+                parts.append(self.unknown[index])
+                parts.append(literals[index + 1])
+                continue
+            if (('{' in value or '}' in value)
+                    or (value and (value[0] == '.' or value[-1] == '.'))
+                    or (not value and self.dotted)):
+                return render_speech_plain(self.text, slots, device)
+            parts.append(clean_speech(value))
+            parts.append(literals[index + 1])
+        return ''.join(parts)
+
+
+def render_speech_plain(text, slots, device):
+    """Renders speech `text` with one replace pass per slot. Handles the
+    corner cases `SpeechTemplate.render` leaves to it
+
+    """
+    for slotname, slot in slots.items():
+        text = text.replace("{{" + slotname + "}}", slot.value or '')
+    return clean_speech(text.replace("{{device}}", device))
+
+
+@lru_cache(maxsize=512)
+def compile_speech(text):
+    """Returns the (cached) `SpeechTemplate` for `text`"""
+    return SpeechTemplate(text)
+
+
+class Record(Mapping):
+    """Base for the compact request records handed to intent apps
+
+    Records store their fields in `__slots__` instead of a per
+    instance dict, but offer a read-only dict view (`record['slots']`,
+    `record.get('slots')`, `dict(record)`) so apps can treat them like
+    the plain dicts they used to be.
+
+    """
+    __slots__ = ()
+    _fields: tuple = ()
+
+    def __getitem__(self, key):
+        if key in self._fields:
+            return getattr(self, key)
+        raise KeyError(key)
+
+    def __iter__(self):
+        return iter(self._fields)
+
+    def __len__(self):
+        return len(self._fields)
+
+    def __repr__(self):
+        return '%s(%s)' % (type(self).__name__, ', '.join(
+            '%s=%r' % (field, getattr(self, field)) for field in self._fields))
+
+    def to_dict(self):
+        """Returns a plain (nested) dict copy of the record"""
+        return {
+            field: _to_plain(getattr(self, field))
+            for field in self._fields
+        }
+
+
+def _to_plain(value):
+    """Converts records (and containers of records) to plain dicts/lists"""
+    if isinstance(value, Record):
+        return value.to_dict()
+    if isinstance(value, dict):
+        return {key: _to_plain(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_to_plain(item) for item in value]
+    return value
+
+
+class Resolution(Record):
+    """A successful entity resolution of a slot value"""
+    _fields = ('id', 'name')
+    __slots__ = _fields
+
+    def __init__(self, id='', name=''):  # pylint: disable=redefined-builtin
+        self.id = id  # pylint: disable=invalid-name
+        self.name = name
+
+
+class Slot(Record):
+    """A slot of an intent with its value and resolutions. The
+    resolutions are flattened from the raw Alexa JSON on first access
+
+    """
+    _fields = ('value', 'resolutions')
+    __slots__ = ('value', '_resolutions', '_raw_resolutions')
+
+    def __init__(self, value=None, resolutions=None, raw_resolutions=None):
+        self.value = value
+        self._resolutions = resolutions
+        self._raw_resolutions = raw_resolutions
+
+    @property
+    def resolutions(self):
+        """Tuple of the successful `Resolution`s of the slot value"""
+        if self._resolutions is None:
+            self._resolutions = flatten_resolutions(self._raw_resolutions)
+            self._raw_resolutions = None
+        return self._resolutions
+
+
+def flatten_resolutions(raw_resolutions):
+    """Returns the values of all ER_SUCCESS_MATCH resolutions in the
+    slot's raw 'resolutions' JSON as tuple of `Resolution`s
+
+    """
+    resolutions = []
+    if not raw_resolutions:
+        return ()
+    for authority in raw_resolutions.get('resolutionsPerAuthority') or ():
+        status = authority.get('status') or EMPTY
+        if status.get('code') != 'ER_SUCCESS_MATCH':
+            continue
+        for rpa_value in authority.get('values') or ():
+            value = rpa_value.get('value') or EMPTY
+            resolutions.append(
+                Resolution(value.get('id', ''), value.get('name', '')))
+    return tuple(resolutions)
+
+
+class Request(Record):
+    """The pre-processed Alexa request passed to the intent apps"""
+    _fields = ('type', 'intent', 'confirmation_status', 'dialog_state',
+               'device', 'slots', 'error')
+    # `states` (a `StateSnapshot`) belongs to the turn only, `pending`
+    # is the app call still running after the deadline of the turn and
+    # `entities` (the `EntityResolver`) belongs to the app. They are no
+    # fields so they are neither in the dict view nor stored with sessions
+    __slots__ = _fields + ('states', 'entities', 'pending')
+
+    # pylint: disable=too-many-arguments
+    def __init__(self,
+                 type='',  # pylint: disable=redefined-builtin
+                 intent='',
+                 confirmation_status='NONE',
+                 dialog_state='',
+                 device='',
+                 slots=None,
+                 error=''):
+        self.type = type
+        self.intent = intent
+        self.confirmation_status = confirmation_status
+        self.dialog_state = dialog_state
+        self.device = device
+        self.slots = slots if slots is not None else {}
+        self.error = error
+        self.states = None
+        self.entities = None
+        self.pending = None
+
+    @classmethod
+    def from_dict(cls, data):
+        """Creates a `Request` from the output of `to_dict`"""
+        data = dict(data)
+        data['slots'] = {
+            name: Slot(
+                slot.get('value'),
+                tuple(
+                    Resolution(resolution.get('id', ''),
+                               resolution.get('name', ''))
+                    for resolution in slot.get('resolutions') or ()))
+            for name, slot in (data.get('slots') or {}).items()
+        }
+        return cls(**data)
+
+
+class StateSnapshot:
+    """Request-scoped view of the Home Assistant states for intent apps
+
+    `get_state` of an entity reads only that entity with `fetch` (i.e.
+    `Hass.get_state(entity_id, attribute='all')`), later reads of it
+    within the turn are answered from what was fetched. Reading a
+    domain or all states fetches all of them at once (`fetch()`), which
+    gets costly with thousands of entities, and answers every read of
+    the turn after that. With a `ttl` the fetched states are also kept
+    in `session` and reused by the next turns of the session for `ttl`
+    seconds, `expire` drops them after that. `stats` counts the
+    'reads', the 'fetches' and the 'session_hits'.
+
+    """
+    __slots__ = ('fetch', 'stats', 'session', 'ttl', 'clock', '_states',
+                 '_all')
+
+    # pylint: disable=too-many-arguments
+    def __init__(self,
+                 fetch,
+                 stats,
+                 session=None,
+                 ttl: float = 0,
+                 clock=time.monotonic):
+        self.fetch = fetch
+        self.stats = stats
+        self.session = session if ttl else None
+        self.ttl = ttl
+        self.clock = clock
+        self._states = {}
+        self._all = None
+
+    def _cached(self, entity_id):
+        """Returns (True, state) if the session has a fresh state of
+        `entity_id` (None for all states), (False, None) otherwise
+
+        """
+        cache = self.session.get('states') if self.session else None
+        if not cache:
+            return False, None
+        now = self.clock()
+        self.expire(self.session, self.ttl, now)
+        entry = cache.get(entity_id)
+        if entry is not None and now - entry[0] < self.ttl:
+            self.stats['session_hits'] += 1
+            return True, entry[1]
+        entry = cache.get(None)
+        if entity_id is not None and entry is not None and (
+                now - entry[0] < self.ttl):
+            self.stats['session_hits'] += 1
+            return True, entry[1].get(entity_id)
+        return False, None
+
+    @staticmethod
+    def expire(session, ttl, now):
+        """Drops the states kept in `session` more than `ttl` seconds
+        before `now`
+
+        """
+        cache = session.get('states')
+        if cache:
+            # Copied, turns of the session may add states meanwhile
+            for entity_id, (fetched, _) in list(cache.items()):
+                if now - fetched >= ttl:
+                    cache.pop(entity_id, None)
+
+    def _remember(self, entity_id, state):
+        """Keeps `state` of `entity_id` (None for all) in the session"""
+        if self.session is not None:
+            self.session.setdefault('states', {})[entity_id] = (self.clock(),
+                                                                state)
+
+    def _everything(self):
+        """Returns all states, fetching them if needed"""
+        if self._all is None:
+            found, states = self._cached(None)
+            if not found:
+                self.stats['fetches'] += 1
+                states = self.fetch() or {}
+                self._remember(None, states)
+            self._all = states
+        return self._all
+
+    def _entity(self, entity_id):
+        """Returns the state dict of `entity_id`, fetching it if needed"""
+        if self._all is not None:
+            return self._all.get(entity_id)
+        try:
+            return self._states[entity_id]
+        except KeyError:
+            pass
+        found, state = self._cached(entity_id)
+        if not found:
+            self.stats['fetches'] += 1
+            state = self.fetch(entity_id, attribute='all')
+            self._remember(entity_id, state)
+        self._states[entity_id] = state
+        return state
+
+    def get_state(self, entity_id=None, attribute=None, default=None):
+        """Works like `Hass.get_state`: returns the state of `entity_id`,
+        its `attribute` ('all' for the whole state dict), the states of a
+        domain (`entity_id` without a '.') or all states
+
+        """
+        self.stats['reads'] += 1
+        if entity_id is None:
+            return self._everything()
+        if '.' not in entity_id:
+            prefix = entity_id + '.'
+            return {
+                key: value
+                for key, value in self._everything().items()
+                if key.startswith(prefix)
+            }
+        state = self._entity(entity_id)
+        if state is None:
+            return default
+        if attribute == 'all':
+            return state
+        if attribute:
+            return state.get('attributes', {}).get(attribute, default)
+        return state.get('state', default)
+
+    def invalidate(self):
+        """Drops the fetched states, i.e. after the app changed states.
+        The next `get_state` fetches them again
+
+        """
+        self._states = {}
+        self._all = None
+        if self.session is not None:
+            self.session.pop('states', None)
+
+
+# Where the `Request` fields are in the Alexa request JSON. Nested
+# dicts mirror the JSON structure, the leaves name the `REQUEST_FIELDS`
+# entry their value goes to
+REQUEST_SCHEMA = {
+    'request': {
+        'type': 'type',
+        'dialogState': 'dialog_state',
+        'error': {
+            'message': 'error'
+        },
+        'intent': {
+            'name': 'intent',
+            'confirmationStatus': 'confirmation_status',
+            'slots': 'slots'
+        }
+    },
+    'context': {
+        'System': {
+            'device': {
+                'deviceId': 'device'
+            }
+        }
+    }
+}
+
+# Arguments of `Request` as collected by `parse_request` and their
+# defaults. 'device' holds the device id until it's translated
+REQUEST_FIELDS = ('type', 'intent', 'confirmation_status', 'dialog_state',
+                  'device', 'slots', 'error')
+REQUEST_DEFAULTS = ('', '', 'NONE', '', '<no_device_id>', EMPTY, '')
+
+
+def compile_schema(schema, fields):
+    """Flattens a nested `schema` into a tuple of (parent, key, index)
+    steps in breadth first order. Each step looks up `key` in the
+    node produced by step `parent` (0 being the root) and either
+    stores it as `fields[index]` or, with index -1, keeps it as a
+    node for the steps below it
+
+    """
+    steps = []
+    queue = [(0, schema)]
+    nodes = 1
+    while queue:
+        parent, node = queue.pop(0)
+        for key, target in node.items():
+            if isinstance(target, dict):
+                steps.append((parent, key, -1))
+                queue.append((nodes, target))
+                nodes += 1
+            else:
+                steps.append((parent, key, fields.index(target)))
+    return tuple(steps)
+
+
+REQUEST_STEPS = compile_schema(REQUEST_SCHEMA, REQUEST_FIELDS)
+
+
+def parse_request(data, device_name):
+    """Parses an Alexa request (the decoded JSON or the raw bytes) into a
+    `Request`, visiting each part of the JSON we need once.
+    `device_name` is called with the device id and returns the name of
+    the device
+
+    """
+    if isinstance(data, (bytes, str)):
+        data = json_loads(data)
+    nodes = [data]
+    values = list(REQUEST_DEFAULTS)
+    for parent, key, index in REQUEST_STEPS:
+        value = nodes[parent].get(key)
+        if index < 0:
+            nodes.append(value if isinstance(value, dict) else EMPTY)
+        elif value is not None:
+            values[index] = value
+
+    # The slots for this intent, their resolutions are only
+    # flattened if an app asks for them
+    slots = {}
+    for slot in values[5].values():
+        slots[slot.get('name')] = Slot(slot.get('value'), None,
+                                       slot.get('resolutions'))
+    values[5] = slots
+    values[4] = device_name(values[4])
+    return Request(*values)
@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+"""metrics.py -- Part of Alexa App for Appdaemon
+Copyright (C) 2021 foorensic
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+https://github.com/foorensic/appdaemon-alexa
+
+Request latency metrics and level-gated request logging
+
+"""
+import random
+import threading
+import time
+from bisect import bisect_left
+
+
+LATENCY_BUCKETS = tuple(0.0001 * 1.5**i for i in range(34))
+
+
+class LatencyHistogram:
+    """Bucketed latency histogram. Percentiles are reported as the upper
+    bound of the bucket they fall in, i.e. at most 50% too high
+
+    """
+    __slots__ = ('buckets', 'count', 'total', 'max')
+
+    def __init__(self):
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        """Records one duration"""
+        self.buckets[bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, percent):
+        """Returns the `percent` percentile in seconds"""
+        if not self.count:
+            return 0.0
+        rank = self.count * percent / 100.0
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if seen >= rank and count:
+                if index < len(LATENCY_BUCKETS):
+                    return min(LATENCY_BUCKETS[index], self.max)
+                return self.max
+        return self.max
+
+    def summary(self):
+        """Returns count, mean, p50/p95/p99 and max in milliseconds"""
+        return {
+            'count': self.count,
+            'mean_ms': round(self.total / self.count * 1000, 3)
+            if self.count else 0.0,
+            'p50_ms': round(self.percentile(50) * 1000, 3),
+            'p95_ms': round(self.percentile(95) * 1000, 3),
+            'p99_ms': round(self.percentile(99) * 1000, 3),
+            'max_ms': round(self.max * 1000, 3)
+        }
+
+
+class Metrics:
+    """Latency histograms and counters per (request type, intent)
+
+    Request types and intents come from the requests, so only the
+    first `max_keys` combinations get their own entry, all later ones
+    share the `OTHER` entry.
+
+    """
+    OTHER = ('other', '')
+
+    def __init__(self, max_keys: int = 100):
+        self.max_keys = max_keys
+        self.lock = threading.Lock()
+        # (request type, intent) -> phase -> LatencyHistogram
+        self.latencies: dict = {}
+        # (request type, intent) -> counter name -> count
+        self.counters: dict = {}
+        self._keys: set = set()
+
+    def _key(self, request):
+        """Returns the entry key of `request`, call with `lock` held"""
+        key = (request.type, request.intent)
+        if key in self._keys:
+            return key
+        if len(self._keys) < self.max_keys:
+            self._keys.add(key)
+            return key
+        return self.OTHER
+
+    def observe(self, request, phase, seconds):
+        """Records that `phase` of `request` took `seconds`"""
+        with self.lock:
+            key = self._key(request)
+            phases = self.latencies.get(key)
+            if phases is None:
+                phases = self.latencies[key] = {}
+            histogram = phases.get(phase)
+            if histogram is None:
+                histogram = phases[phase] = LatencyHistogram()
+            histogram.add(seconds)
+
+    def count(self, request, name, amount=1):
+        """Increments counter `name` of `request`'s type and intent"""
+        with self.lock:
+            key = self._key(request)
+            counters = self.counters.get(key)
+            if counters is None:
+                counters = self.counters[key] = {}
+            counters[name] = counters.get(name, 0) + amount
+
+    def snapshot(self):
+        """Returns all latency summaries and counters, keyed by
+        'RequestType' or 'RequestType/intent'
+
+        """
+        result: dict = {}
+        with self.lock:
+            for (request_type, intent), phases in self.latencies.items():
+                entry = result.setdefault(
+                    '/'.join(filter(None, [request_type, intent])), {})
+                for phase, histogram in phases.items():
+                    entry[phase] = histogram.summary()
+            for (request_type, intent), counters in self.counters.items():
+                entry = result.setdefault(
+                    '/'.join(filter(None, [request_type, intent])), {})
+                entry['counters'] = dict(counters)
+        return result
+
+
+LOG_LEVELS = {'DEBUG': 10, 'INFO': 20, 'WARNING': 30, 'ERROR': 40, 'OFF': 50}
+
+
+class RequestLogger:
+    """Level-gated logging for the request path
+
+    Messages are passed on to `log` (`Hass.log(msg, *args, level=...)`)
+    with their arguments, so they are only formatted if emitted, and
+    messages below `level` do not even get there. DEBUG messages, the
+    per-request chatter, are emitted at AppDaemon's INFO level (which
+    it does not filter by default) and only for the `sample_rate`
+    share of the requests. `begin` and `end` frame a request on the
+    current thread, `note` adds fields to it and `end` emits one
+    summary record of the request.
+
+    """
+    # pylint: disable=too-many-arguments
+    def __init__(self,
+                 log,
+                 level='INFO',
+                 sample_rate: float = 1,
+                 summary=True,
+                 rng=random.random):
+        self.log = log
+        self.level = LOG_LEVELS.get(str(level).upper())
+        if self.level is None:
+            log('Unknown logLevel %r (use one of %s), logging at INFO',
+                level, ', '.join(LOG_LEVELS), level='WARNING')
+            self.level = LOG_LEVELS['INFO']
+        self.sample_rate = sample_rate
+        self.debug_enabled = self.level <= LOG_LEVELS['DEBUG']
+        self.summary = summary and self.level <= LOG_LEVELS['INFO']
+        self.rng = rng
+        self._local = threading.local()
+
+    def begin(self):
+        """Starts logging a request on this thread"""
+        local = self._local
+        local.started = time.perf_counter()
+        local.sampled = self.debug_enabled and (
+            self.sample_rate >= 1 or self.rng() < self.sample_rate)
+        local.fields = {
+            'session': '',
+            'type': '',
+            'intent': '',
+            'phase': '',
+            'outcome': 'ok'
+        }
+
+    def note(self, **fields):
+        """Sets fields of the summary of the current request"""
+        fields_ = getattr(self._local, 'fields', None)
+        if fields_ is not None:
+            fields_.update(fields)
+
+    def end(self, status):
+        """Emits the summary of the current request with HTTP `status`"""
+        local = self._local
+        fields = getattr(local, 'fields', None)
+        local.fields = None
+        local.sampled = True
+        if fields is None or not self.summary:
+            return
+        self.log(
+            'request session=%s type=%s intent=%s phase=%s outcome=%s '
+            'status=%s ms=%.2f', fields['session'], fields['type'],
+            fields['intent'], fields['phase'], fields['outcome'], status,
+            (time.perf_counter() - local.started) * 1000)
+
+    def debug(self, msg, *args):
+        """Logs per-request chatter, if the request is sampled. Outside
+        of requests, DEBUG messages just need the level
+
+        """
+        if self.debug_enabled and getattr(self._local, 'sampled', True):
+            self.log(msg, *args)
+
+    def info(self, msg, *args):
+        """Logs `msg % args` at INFO"""
+        if self.level <= LOG_LEVELS['INFO']:
+            self.log(msg, *args)
+
+    def warning(self, msg, *args):
+        """Logs `msg % args` at WARNING"""
+        if self.level <= LOG_LEVELS['WARNING']:
+            self.log(msg, *args, level='WARNING')
+
+    def error(self, msg, *args):
+        """Logs `msg % args` at ERROR"""
+        if self.level <= LOG_LEVELS['ERROR']:
+            self.log(msg, *args, level='ERROR')
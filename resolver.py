@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+"""resolver.py -- Part of Alexa App for Appdaemon
+Copyright (C) 2021 foorensic
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+https://github.com/foorensic/appdaemon-alexa
+
+Fuzzy matching of spoken names to Home Assistant entities
+
+"""
+import heapq
+import re
+import threading
+
+import helpers
+
+
+SOUNDEX_CODES = dict(
+    [(letter, '1') for letter in 'bfpv'] +
+    [(letter, '2') for letter in 'cgjkqsxz'] + [(letter, '3')
+                                                  for letter in 'dt'] +
+    [('l', '4'), ('m', '5'), ('n', '5'), ('r', '6')])
+
+
+def normalize_name(text):
+    """Lower case words of `text`, without punctuation or underscores"""
+    return ' '.join(re.sub(r'[^0-9a-z]+', ' ', str(text).lower()).split())
+
+
+def phonetic_key(text):
+    """Soundex-like key of the normalized `text` with the spaces
+    dropped, so 'living room', 'livingroom' and 'liveing rum' match
+
+    """
+    text = text.replace(' ', '')
+    if not text:
+        return ''
+    key = [text[0]]
+    last = SOUNDEX_CODES.get(text[0], '')
+    for char in text[1:]:
+        code = SOUNDEX_CODES.get(char, '')
+        if code and code != last:
+            key.append(code)
+        if char not in 'hw':
+            last = code
+    return ''.join(key)
+
+
+def trigrams(text):
+    """Character trigrams of the normalized `text`, padded with spaces"""
+    text = ' %s ' % text
+    return frozenset(text[i:i + 3] for i in range(len(text) - 2))
+
+
+class EntityResolver:
+    """Fuzzy matching of spoken names (slot values) to Home Assistant
+    entities, for when Alexa's entity resolution found nothing
+
+    Each entity is indexed under its names (the friendly name, its
+    object id and any aliases) by character trigrams and by a phonetic
+    key. Lookups only score the entities sharing the rarer trigrams of
+    the query (Dice coefficient), an equal phonetic key scores at least
+    `PHONETIC_SCORE`. Entities can be added, renamed and removed at any
+    time, only their own index entries change. Only entities of
+    `domains` are indexed if given. If there is a `load` function, it
+    is called once before the first lookup to fill the index (i.e. with
+    `update_from_states`), so nothing is indexed unless it is used.
+
+    """
+    PHONETIC_SCORE = 0.8
+    # Trigrams in more than this share of the names (i.e. ' li' or
+    # 'ght') do not select candidates on their own
+    COMMON_SHARE = 0.05
+    # How many of the candidates sharing the most rare trigrams with the
+    # query get scored
+    CANDIDATES = 100
+
+    def __init__(self, domains=None, min_score: float = 0.5, load=None):
+        self.domains = set(domains) if domains else None
+        self.min_score = min_score
+        self.load = load
+        self.lock = threading.Lock()
+        self.load_lock = threading.Lock()
+        # name id -> (entity id, name, trigrams, phonetic key)
+        self._names: dict = {}
+        self._next_id = 0
+        # entity id -> name ids
+        self._entities: dict = {}
+        # trigram -> name ids, phonetic key -> name ids
+        self._grams: dict = {}
+        self._phonetic: dict = {}
+        self.stats = {'lookups': 0, 'hits': 0}
+
+    def __len__(self):
+        return len(self._entities)
+
+    def add(self, entity_id, names):
+        """Indexes (or re-indexes) `entity_id` under `names`"""
+        if self.domains is not None and entity_id.split(
+                '.', 1)[0] not in self.domains:
+            return
+        names = list(names) + [entity_id.split('.', 1)[-1]]
+        with self.lock:
+            self._remove(entity_id)
+            ids = []
+            seen = set()
+            for name in names:
+                normalized = normalize_name(name or '')
+                if not normalized or normalized in seen:
+                    continue
+                seen.add(normalized)
+                name_id = self._next_id
+                self._next_id += 1
+                grams = trigrams(normalized)
+                key = phonetic_key(normalized)
+                self._names[name_id] = (entity_id, str(name).replace('_', ' '),
+                                        grams, key)
+                for gram in grams:
+                    self._grams.setdefault(gram, set()).add(name_id)
+                self._phonetic.setdefault(key, set()).add(name_id)
+                ids.append(name_id)
+            self._entities[entity_id] = ids
+
+    def remove(self, entity_id):
+        """Drops `entity_id` from the index"""
+        with self.lock:
+            self._remove(entity_id)
+
+    def _remove(self, entity_id):
+        for name_id in self._entities.pop(entity_id, ()):
+            _, _, grams, key = self._names.pop(name_id)
+            for gram in grams:
+                ids = self._grams[gram]
+                ids.discard(name_id)
+                if not ids:
+                    del self._grams[gram]
+            self._phonetic[key].discard(name_id)
+            if not self._phonetic[key]:
+                del self._phonetic[key]
+
+    def update_from_states(self, states, aliases=None):
+        """Indexes all entities in `states` (as `Hass.get_state()` returns
+        them) under their friendly names and `aliases` (entity id ->
+        list of names)
+
+        """
+        aliases = aliases or {}
+        for entity_id, state in (states or {}).items():
+            self.add(entity_id, [((state or {}).get('attributes')
+                                  or {}).get('friendly_name', '')] +
+                     list(aliases.get(entity_id, ())))
+
+    def _load(self):
+        """Fills the index with `load`, once"""
+        with self.load_lock:
+            if self.load is not None:
+                self.load()
+                self.load = None
+
+    def match(self, text, domain=None, limit: int = 3, min_score=None):
+        """Returns up to `limit` (score, entity id, name) matches of the
+        spoken `text`, best first. `domain` limits them to entities of
+        that domain
+
+        """
+        query = normalize_name(text or '')
+        min_score = self.min_score if min_score is None else min_score
+        if not query:
+            return []
+        if self.load is not None:
+            self._load()
+        grams = trigrams(query)
+        phonetic = phonetic_key(query)
+        prefix = domain + '.' if domain else ''
+        with self.lock:
+            self.stats['lookups'] += 1
+            postings = sorted(
+                (self._grams[gram] for gram in grams if gram in self._grams),
+                key=len)
+            common = max(len(self._names) * self.COMMON_SHARE, 10)
+            # Names sharing the most rare trigrams (and phonetic
+            # matches) are scored
+            counts: dict = dict.fromkeys(self._phonetic.get(phonetic, ()),
+                                         len(grams))
+            for ids in postings:
+                if len(ids) > common and counts:
+                    break
+                for name_id in ids:
+                    counts[name_id] = counts.get(name_id, 0) + 1
+            matches = {}
+            for name_id in heapq.nlargest(self.CANDIDATES, counts,
+                                          counts.get):
+                entity_id, name, name_grams, key = self._names[name_id]
+                if not entity_id.startswith(prefix):
+                    continue
+                score = 2.0 * len(grams & name_grams) / (len(grams) +
+                                                         len(name_grams))
+                if score < self.PHONETIC_SCORE and key == phonetic:
+                    score = self.PHONETIC_SCORE
+                if score >= min_score and score > matches.get(
+                        entity_id, (0, ))[0]:
+                    matches[entity_id] = (score, entity_id, name)
+            if matches:
+                self.stats['hits'] += 1
+        return sorted(matches.values(), reverse=True)[:limit]
+
+    def resolve(self, text, domain=None):
+        """Returns the best match of `text` as `Resolution` (entity id,
+        name) or None
+
+        """
+        matches = self.match(text, domain, limit=1)
+        if not matches:
+            return None
+        return helpers.Resolution(matches[0][1], matches[0][2])
+
+    def get_stats(self):
+        """Returns the counters and the size of the index"""
+        return dict(self.stats,
+                    entities=len(self._entities),
+                    loaded=self.load is None)
@@ -0,0 +1,688 @@
+#!/usr/bin/env python
+"""sessions.py -- Part of Alexa App for Appdaemon
+Copyright (C) 2021 foorensic
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+https://github.com/foorensic/appdaemon-alexa
+
+Dialog sessions and the backends they can be stored in
+
+"""
+import hashlib
+import json
+import socket
+import sqlite3
+import threading
+import time
+from bisect import bisect_left, insort
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+import helpers
+
+
+class SessionBusy(Exception):
+    """A session stayed locked by another turn for too long"""
+
+
+class SessionStore:
+    """Bounded store for dialog sessions
+
+    Sessions expire `ttl` seconds after they were last accessed, at
+    most `max_sessions` are kept (least recently used ones are evicted
+    first) and each session only keeps the last `max_requests` turns
+    in its 'requests' history. Alexa does not reliably send a
+    SessionEndedRequest, so without these limits abandoned sessions
+    would pile up forever.
+
+    The store is thread safe. Each session also has its own 'lock',
+    see `locked`, so turns of one session are handled one after the
+    other while different sessions are handled in parallel.
+
+    Without a `backend` sessions only live in this process. With a
+    `SessionBackend` every turn added with `append` is also written
+    there, and sessions not in memory are looked up in the backend, so
+    they survive restarts. If the backend is `shared` with other
+    instances, `append` also fetches the turns they added. When the
+    backend fails, sessions carry on in memory and the error is passed
+    to `on_error` (i.e. to log it). Backend calls are made without
+    holding the store's lock.
+
+    """
+    # pylint: disable=too-many-arguments
+    def __init__(self,
+                 ttl: float = 300,
+                 max_sessions: int = 1000,
+                 max_requests: int = 20,
+                 clock=time.monotonic,
+                 backend=None,
+                 wall_clock=time.time,
+                 on_error=None):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.max_requests = max_requests
+        self.clock = clock
+        self.backend = backend
+        self.wall_clock = wall_clock
+        self.on_error = on_error
+        # Only held for lookups and changes of `_sessions`
+        self.lock = threading.RLock()
+        # Ordered by last access, oldest first
+        self._sessions: OrderedDict = OrderedDict()
+        self.stats = {
+            'created': 0,
+            'removed': 0,
+            'expired': 0,
+            'evicted': 0,
+            'loaded': 0,
+            'backend_errors': 0
+        }
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def __contains__(self, session_id):
+        return self.get(session_id) is not None
+
+    def __getitem__(self, session_id):
+        session = self.get(session_id)
+        if session is None:
+            raise KeyError(session_id)
+        return session
+
+    def __delitem__(self, session_id):
+        if not self.pop(session_id):
+            raise KeyError(session_id)
+
+    def get(self, session_id, default=None):
+        """Returns the session `session_id` and marks it as recently used,
+        or `default` if there is no such (unexpired) session
+
+        """
+        return self._get(session_id, self.backend is not None, default)
+
+    def _get(self, session_id, load, default=None):
+        """`get`, loading the session from the backend if `load` is set"""
+        with self.lock:
+            session = self._sessions.get(session_id)
+            if session is not None:
+                now = self.clock()
+                if now - session['last_seen'] > self.ttl:
+                    del self._sessions[session_id]
+                    self.stats['expired'] += 1
+                    return default
+                session['last_seen'] = now
+                self._sessions.move_to_end(session_id)
+                return session
+            if not load:
+                return default
+        requests = self._load(session_id)
+        if requests is None:
+            return default
+        with self.lock:
+            # Another thread may have added it in the meantime
+            session = self._sessions.get(session_id)
+            if session is None:
+                session = self._add(session_id, requests)
+                self.stats['loaded'] += 1
+            return session
+
+    def _get_or_add(self, session_id):
+        """Returns session `session_id`, added if there is none. Sessions
+        of a shared backend are not loaded, `append` fetches their turns
+
+        """
+        shared = self.backend is not None and self.backend.shared
+        session = self._get(session_id, self.backend is not None
+                            and not shared)
+        if session is not None:
+            return session
+        with self.lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                session = self._add(session_id, ())
+                self.stats['created'] += 1
+            return session
+
+    def _add(self, session_id, requests):
+        """Adds a session with `requests` to the ones in memory"""
+        self.purge()
+        self._sessions.pop(session_id, None)
+        # With a backend, evicted sessions can still be loaded again
+        while self._sessions and len(self._sessions) >= self.max_sessions:
+            self._sessions.popitem(last=False)
+            self.stats['evicted'] += 1
+        session = {
+            'requests': deque(requests, maxlen=self.max_requests),
+            'last_seen': self.clock(),
+            'lock': threading.Lock()
+        }
+        self._sessions[session_id] = session
+        return session
+
+    def _load(self, session_id):
+        """Loads the turns of session `session_id` from the backend as
+        `Request`s, None if it is not there, expired, unreadable or the
+        backend failed. Unreadable sessions are deleted
+
+        """
+        try:
+            stored = self.backend.load(session_id, self.max_requests)
+            if stored is None:
+                return None
+            last_seen, requests = stored
+            if self.wall_clock() - last_seen > self.ttl:
+                self.backend.delete(session_id)
+                with self.lock:
+                    self.stats['expired'] += 1
+                return None
+            return [
+                helpers.Request.from_dict(request) for request in requests
+            ]
+        except BACKEND_ERRORS as err:
+            self._backend_failed(err)
+        except (AttributeError, TypeError, ValueError) as err:
+            # Corrupt JSON or turns stored by an incompatible version
+            self._backend_failed(err)
+            try:
+                self.backend.delete(session_id)
+            except BACKEND_ERRORS as delete_err:
+                self._backend_failed(delete_err)
+        return None
+
+    def _backend_failed(self, err):
+        """Counts and reports an error of the backend"""
+        with self.lock:
+            self.stats['backend_errors'] += 1
+        if self.on_error is not None:
+            self.on_error(err)
+
+    def append(self, session_id, session, request):
+        """Adds `request` as latest turn to `session` (as returned by
+        `get` or `locked` for `session_id`)
+
+        """
+        if self.backend is None:
+            session['requests'].append(request)
+            return
+        try:
+            turns = self.backend.append(session_id, request.to_dict(),
+                                        self.wall_clock(), self.max_requests)
+        except BACKEND_ERRORS as err:
+            self._backend_failed(err)
+            turns = None
+        if turns is None:
+            session['requests'].append(request)
+            return
+        # A shared backend returns all turns, including the ones other
+        # instances added since we last saw the session
+        turns = [helpers.Request.from_dict(turn) for turn in turns[:-1]]
+        session['requests'] = deque(turns + [request],
+                                    maxlen=self.max_requests)
+
+    @contextmanager
+    def locked(self, session_id, timeout=None):
+        """Context manager holding the lock of session `session_id` (which
+        is created if needed) and returning the session. If a future is
+        left in the session's 'pending', the lock is held until it is
+        done. Raises `SessionBusy` if the lock is not free within
+        `timeout` seconds
+
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            session = self._get_or_add(session_id)
+            if deadline is None:
+                session['lock'].acquire()
+            elif not session['lock'].acquire(
+                    timeout=max(deadline - time.monotonic(), 0)):
+                raise SessionBusy(session_id)
+            # The previous turn may have ended the session while we
+            # were waiting, then we need a new one
+            if self._sessions.get(session_id) is session:
+                break
+            session['lock'].release()
+        try:
+            yield session
+        finally:
+            # A call of the turn still running in the background keeps
+            # the session locked until it is done
+            pending = session.pop('pending', None)
+            if pending is None:
+                session['lock'].release()
+            else:
+                pending.add_done_callback(
+                    lambda _: session['lock'].release())
+
+    def pop(self, session_id):
+        """Removes the session `session_id`. Returns True if it existed"""
+        with self.lock:
+            existed = self._sessions.pop(session_id, None) is not None
+        if self.backend is not None:
+            try:
+                existed = self.backend.delete(session_id) or existed
+            except BACKEND_ERRORS as err:
+                self._backend_failed(err)
+        if existed:
+            with self.lock:
+                self.stats['removed'] += 1
+        return existed
+
+    def purge(self):
+        """Drops all expired sessions and returns how many were dropped"""
+        with self.lock:
+            expired = self._drop_expired()
+            self.stats['expired'] += expired
+        return expired
+
+    def values(self):
+        """Returns the sessions kept in memory, expired ones included"""
+        with self.lock:
+            return list(self._sessions.values())
+
+    def _drop_expired(self):
+        """Drops expired sessions from memory, returns how many"""
+        expired = 0
+        deadline = self.clock() - self.ttl
+        # Oldest first, so we can stop at the first unexpired session
+        while self._sessions:
+            session_id, session = next(iter(self._sessions.items()))
+            if session['last_seen'] >= deadline:
+                break
+            del self._sessions[session_id]
+            expired += 1
+        return expired
+
+    def compact(self):
+        """Drops expired sessions from memory and the backend. Returns how
+        many were dropped
+
+        """
+        if self.backend is None:
+            return self.purge()
+        with self.lock:
+            # The backend has all of them, so count them there
+            self._drop_expired()
+        try:
+            expired = self.backend.compact(self.wall_clock() - self.ttl,
+                                           self.max_requests)
+        except BACKEND_ERRORS as err:
+            self._backend_failed(err)
+            return 0
+        with self.lock:
+            self.stats['expired'] += expired
+        return expired
+
+    def get_stats(self):
+        """Returns the eviction stats along with the current session count"""
+        with self.lock:
+            return dict(self.stats, sessions=len(self._sessions))
+
+
+class SessionBackend:
+    """Interface of the storage behind a `SessionStore`
+
+    Backends store the turns of a session as plain dicts (see
+    `helpers.Request.to_dict`) and the time the session was last seen.
+
+    """
+    # Whether other processes use the same sessions. `append` then
+    # returns all turns of the session
+    shared = False
+
+    def load(self, session_id, max_requests):
+        """Returns (last seen, last `max_requests` requests as dicts) of
+        session `session_id` or None if there is no such session
+
+        """
+        raise NotImplementedError
+
+    def append(self, session_id, request, last_seen, max_requests):
+        """Stores `request` (a dict) as latest turn of `session_id`. Shared
+        backends return the last `max_requests` turns, others None
+
+        """
+        raise NotImplementedError
+
+    def delete(self, session_id):
+        """Deletes session `session_id`. Returns True if it is known to
+        have existed
+
+        """
+        raise NotImplementedError
+
+    def compact(self, deadline, max_requests):
+        """Deletes sessions last seen before `deadline` and all but the
+        last `max_requests` turns of the others. Returns the number of
+        deleted sessions
+
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """Releases the resources of the backend"""
+
+
+class SqliteSessionBackend(SessionBackend):
+    """Keeps the turns of the sessions in a SQLite database
+
+    Each turn is one row, written when it happens, so nothing is lost
+    if AppDaemon stops. Sessions are only read when they are needed,
+    and `compact` removes expired sessions and surplus turns.
+
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS sessions (
+            id TEXT PRIMARY KEY,
+            last_seen REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS turns (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            session_id TEXT NOT NULL,
+            request TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS turns_session ON turns (session_id, seq);
+        CREATE INDEX IF NOT EXISTS sessions_last_seen ON sessions (last_seen);
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.executescript(self.SCHEMA)
+
+    def load(self, session_id, max_requests):
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT last_seen FROM sessions WHERE id = ?',
+                (session_id, )).fetchone()
+            if row is None:
+                return None
+            turns = self.connection.execute(
+                'SELECT request FROM turns WHERE session_id = ? '
+                'ORDER BY seq DESC LIMIT ?',
+                (session_id, max_requests)).fetchall()
+        return row[0], [helpers.json_loads(turn[0]) for turn in reversed(turns)]
+
+    def append(self, session_id, request, last_seen, max_requests):  # pylint: disable=unused-argument
+        data = json.dumps(request, separators=(',', ':'))
+        with self.lock, self.connection:
+            self.connection.execute(
+                'INSERT INTO sessions (id, last_seen) VALUES (?, ?) '
+                'ON CONFLICT (id) DO UPDATE SET last_seen = excluded.last_seen',
+                (session_id, last_seen))
+            self.connection.execute(
+                'INSERT INTO turns (session_id, request) VALUES (?, ?)',
+                (session_id, data))
+
+    def delete(self, session_id):
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM turns WHERE session_id = ?',
+                                    (session_id, ))
+            return self.connection.execute(
+                'DELETE FROM sessions WHERE id = ?',
+                (session_id, )).rowcount > 0
+
+    def compact(self, deadline, max_requests):
+        with self.lock, self.connection:
+            expired = self.connection.execute(
+                'DELETE FROM sessions WHERE last_seen < ?',
+                (deadline, )).rowcount
+            self.connection.execute(
+                'DELETE FROM turns WHERE session_id NOT IN '
+                '(SELECT id FROM sessions)')
+            self.connection.execute(
+                'DELETE FROM turns WHERE seq IN (SELECT seq FROM '
+                '(SELECT seq, ROW_NUMBER() OVER (PARTITION BY session_id '
+                'ORDER BY seq DESC) AS age FROM turns) WHERE age > ?)',
+                (max_requests, ))
+        return expired
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+class RespError(Exception):
+    """Error reply from a server speaking the Redis protocol"""
+
+
+# Errors of the session backends, `SessionStore` then carries on in memory
+BACKEND_ERRORS = (OSError, sqlite3.Error, RespError)
+
+
+class RespClient:
+    """Minimal client for key-value servers speaking the Redis protocol
+    (RESP). Commands are always sent as pipeline, so any number of
+    them costs one round trip
+
+    """
+    def __init__(self, host, port=6379, timeout: float = 2):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.sock = None
+        self.reader = None
+        self.round_trips = 0
+
+    def pipeline(self, *commands):
+        """Sends all `commands` (lists of arguments) at once and returns
+        the list of their replies. Error replies are raised as `RespError`.
+        Only a send on a connection the server already closed is retried:
+        once sent, commands may have run, so they are never sent twice
+
+        """
+        payload = b''.join(self._encode(command) for command in commands)
+        with self.lock:
+            try:
+                if self.sock is not None and self._stale():
+                    self._close()
+                if self.sock is None:
+                    self._connect()
+                    self.sock.sendall(payload)
+                else:
+                    try:
+                        self.sock.sendall(payload)
+                    except (BrokenPipeError, ConnectionResetError):
+                        # Closed while idle, so nothing arrived
+                        self._close()
+                        self._connect()
+                        self.sock.sendall(payload)
+                replies = [self._read() for _ in commands]
+            except OSError:
+                self._close()
+                raise
+            self.round_trips += 1
+        for reply in replies:
+            if isinstance(reply, RespError):
+                raise reply
+        return replies
+
+    def _stale(self):
+        """Whether the server closed the idle connection"""
+        self.sock.settimeout(0)
+        try:
+            return self.sock.recv(1, socket.MSG_PEEK) == b''
+        except BlockingIOError:
+            return False
+        except OSError:
+            return True
+        finally:
+            self.sock.settimeout(self.timeout)
+
+    @staticmethod
+    def _encode(command):
+        """Encodes a command as RESP array of bulk strings"""
+        parts = [b'*%d\r\n' % len(command)]
+        for arg in command:
+            if not isinstance(arg, bytes):
+                arg = str(arg).encode()
+            parts.append(b'$%d\r\n%s\r\n' % (len(arg), arg))
+        return b''.join(parts)
+
+    def _read(self):
+        """Reads one reply"""
+        line = self.reader.readline()
+        if not line.endswith(b'\r\n'):
+            raise ConnectionError('Connection closed by server')
+        kind, value = line[:1], line[1:-2]
+        if kind == b'+':
+            return value.decode()
+        if kind == b'-':
+            return RespError(value.decode())
+        if kind == b':':
+            return int(value)
+        if kind == b'$':
+            if int(value) < 0:
+                return None
+            data = self.reader.read(int(value) + 2)
+            return data[:-2]
+        if kind == b'*':
+            if int(value) < 0:
+                return None
+            return [self._read() for _ in range(int(value))]
+        raise ConnectionError('Invalid reply from server: %r' % line)
+
+    def _connect(self):
+        self.sock = socket.create_connection((self.host, self.port),
+                                             self.timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.reader = self.sock.makefile('rb')
+
+    def _close(self):
+        if self.sock is not None:
+            try:
+                self.reader.close()
+                self.sock.close()
+            except OSError:
+                pass
+        self.sock = None
+        self.reader = None
+
+    def close(self):
+        """Closes the connection"""
+        with self.lock:
+            self._close()
+
+
+class RespSessionBackend(SessionBackend):
+    """Keeps sessions on a key-value server speaking the Redis protocol,
+    so several AlexaAPI instances can share them. Each session is a list
+    of JSON encoded turns that expires `ttl` seconds after the last
+    turn. Every call is a single round trip. Deleted sessions are ended
+    ones Alexa does not come back to, so their keys are only deleted
+    with the next call (or `compact`) instead of in a round trip of
+    their own. Should that call fail, they still expire
+
+    """
+    shared = True
+
+    def __init__(self, client, ttl, prefix='alexa:session:'):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self._deletes: list = []
+
+    def _pipeline(self, *commands):
+        """Sends `commands` along with the pending deletes and returns
+        their replies
+
+        """
+        with self.lock:
+            deletes, self._deletes = self._deletes, []
+        if not deletes:
+            return self.client.pipeline(*commands)
+        return self.client.pipeline(['DEL'] + deletes, *commands)[1:]
+
+    def load(self, session_id, max_requests):
+        key = self.prefix + session_id
+        turns, ttl_ms = self._pipeline(['LRANGE', key, -max_requests, -1],
+                                       ['PTTL', key])
+        if not turns:
+            return None
+        last_seen = time.time()
+        if ttl_ms > 0:
+            last_seen -= self.ttl - ttl_ms / 1000.0
+        return last_seen, [helpers.json_loads(turn) for turn in turns]
+
+    def append(self, session_id, request, last_seen, max_requests):
+        key = self.prefix + session_id
+        replies = self._pipeline(
+            ['RPUSH', key, json.dumps(request, separators=(',', ':'))],
+            ['LTRIM', key, -max_requests, -1],
+            ['PEXPIRE', key, int(self.ttl * 1000)],
+            ['LRANGE', key, 0, -1])
+        return [helpers.json_loads(turn) for turn in replies[-1]]
+
+    def delete(self, session_id):
+        with self.lock:
+            self._deletes.append(self.prefix + session_id)
+        return False
+
+    def compact(self, deadline, max_requests):
+        # The server expires the sessions, turns are trimmed on append
+        with self.lock:
+            deletes, self._deletes = self._deletes, []
+        if deletes:
+            self.client.pipeline(['DEL'] + deletes)
+        return 0
+
+    def close(self):
+        self.client.close()
+
+
+class ConsistentHashRing:
+    """Consistent hashing of keys onto nodes. A proxy in front of
+    several AlexaAPI instances can use it to send all turns of a
+    session to the same instance (by `sessionId`), and only the
+    sessions of a node move when nodes are added or removed
+
+    """
+    def __init__(self, nodes=(), replicas: int = 100):
+        self.replicas = replicas
+        self._hashes: list = []
+        self._nodes: dict = {}
+        for node in nodes:
+            self.add(node)
+
+    @staticmethod
+    def _hash(key):
+        return int.from_bytes(
+            hashlib.md5(key.encode()).digest()[:8], 'big')
+
+    def add(self, node):
+        """Adds `node` to the ring"""
+        for replica in range(self.replicas):
+            point = self._hash('%s#%d' % (node, replica))
+            self._nodes[point] = node
+            insort(self._hashes, point)
+
+    def remove(self, node):
+        """Removes `node` from the ring"""
+        for replica in range(self.replicas):
+            point = self._hash('%s#%d' % (node, replica))
+            if self._nodes.pop(point, None) is not None:
+                del self._hashes[bisect_left(self._hashes, point)]
+
+    def get(self, key):
+        """Returns the node for `key`, None if there are no nodes"""
+        if not self._hashes:
+            return None
+        index = bisect_left(self._hashes, self._hash(key))
+        return self._nodes[self._hashes[index % len(self._hashes)]]
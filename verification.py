@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+"""verification.py -- Part of Alexa App for Appdaemon
+Copyright (C) 2021 foorensic
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+https://github.com/foorensic/appdaemon-alexa
+
+Verification of Alexa request timestamps
+
+"""
+from datetime import datetime
+
+
+class RequestVerificationError(Exception):
+    """An Alexa request failed verification"""
+
+
+def check_timestamp(timestamp, max_age, now):
+    """Raises `RequestVerificationError` unless the ISO 8601 `timestamp`
+    of a request is within `max_age` seconds of `now` (epoch seconds)
+
+    """
+    try:
+        sent = datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
+        age = now - sent.timestamp()
+    except (AttributeError, TypeError, ValueError) as err:
+        raise RequestVerificationError('invalid timestamp %r' %
+                                       timestamp) from err
+    if abs(age) > max_age:
+        raise RequestVerificationError('timestamp is %d seconds off' % age)